@@ -0,0 +1,340 @@
+# -*- coding: utf-8 -*-
+
+# (c) 2018, Ansible by Red Hat, inc
+# GNU General Public License v3.0+ (see COPYING or https://www.gnu.org/licenses/gpl-3.0.txt)
+#
+# You should have received a copy of the GNU General Public License
+# along with Ansible.  If not, see <http://www.gnu.org/licenses/>.
+#
+from __future__ import (absolute_import, division, print_function)
+__metaclass__ = type
+
+import os
+import sys
+import json
+import time
+import zlib
+import hashlib
+import tempfile
+
+from ansible.plugins.action import ActionBase
+from ansible.module_utils._text import to_bytes, to_text
+from ansible.errors import AnsibleError
+
+try:
+    from importlib.util import spec_from_file_location, module_from_spec
+except ImportError:
+    import imp
+    spec_from_file_location = None
+
+# a new chunk is started at a top level statement when the crc of the line
+# has these bits cleared, so on average a chunk holds CHUNK_MASK + 1
+# statements.  the boundaries only depend on the statement itself, so an
+# edit only changes the chunk that holds it
+CHUNK_MASK = 0x07
+
+# a new chunk is started at a nested statement when the crc of the line has
+# these bits cleared, so the long sections of braced configurations, such
+# as the junos interfaces, are split as well
+NESTED_CHUNK_MASK = 0xff
+
+# chunks are always cut at the next line once they grow to this many bytes
+MAX_CHUNK_SIZE = 64 * 1024
+
+# the chunk hashes of a version are grouped into pages the same way
+PAGE_MASK = 0x1f
+
+
+def load_module(name):
+    """ Loads a module of the network_config directory next to the plugins
+
+    The role is not on the python path of the controller, so the code shared
+    by the action plugins is loaded from its file, once per process.
+    """
+    full_name = 'network_config_%s' % name
+    module = sys.modules.get(full_name)
+    if module is not None:
+        return module
+
+    path = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'network_config', '%s.py' % name)
+    if spec_from_file_location is None:
+        return imp.load_source(full_name, path)
+
+    spec = spec_from_file_location(full_name, path)
+    module = module_from_spec(spec)
+    sys.modules[full_name] = module
+    try:
+        spec.loader.exec_module(module)
+    except Exception:
+        del sys.modules[full_name]
+        raise
+    return module
+
+
+common = load_module('common')
+
+
+def write_file(path, data, mode=None):
+    """ Atomically writes data to path, creating the directory if needed
+
+    :param path: The destination file
+    :param data: The bytes to write
+    :param mode: The permissions of the file, the file is only readable by
+        the owner if None
+    """
+    dirname = os.path.dirname(path)
+    if not os.path.isdir(dirname):
+        try:
+            os.makedirs(dirname)
+        except OSError:
+            if not os.path.isdir(dirname):
+                raise
+    fd, tmp_path = tempfile.mkstemp(dir=dirname, prefix='.backup.')
+    with os.fdopen(fd, 'wb') as f:
+        f.write(data)
+    if mode is not None:
+        os.chmod(tmp_path, mode)
+    os.rename(tmp_path, path)
+
+
+def file_digest(path):
+    """ Returns the sha1 of the content of path or None if it does not exist
+    """
+    digest = hashlib.sha1()
+    try:
+        with open(path, 'rb') as f:
+            for block in iter(lambda: f.read(65536), b''):
+                digest.update(block)
+    except (IOError, OSError):
+        return None
+    return digest.hexdigest()
+
+
+def split_chunks(data):
+    """ Splits the configuration into content defined chunks
+
+    Chunks are split at the start of statements, mostly top level ones,
+    that is lines that are not indented, and once in a while nested ones.
+    A chunk that reaches MAX_CHUNK_SIZE is cut at the next line whatever it
+    holds.  Joining the chunks returns the original data.
+
+    :param data: The configuration as bytes
+
+    :returns: list of chunks
+    """
+    chunks = list()
+    start = 0
+    offset = 0
+
+    for line in data.splitlines(True):
+        if offset > start:
+            if offset - start >= MAX_CHUNK_SIZE:
+                cut = True
+            elif line[:1] not in (b' ', b'\t', b'}'):
+                cut = not zlib.crc32(line) & CHUNK_MASK
+            else:
+                statement = line.strip()
+                cut = statement[:1] not in (b'', b'}') and not zlib.crc32(line) & NESTED_CHUNK_MASK
+            if cut:
+                chunks.append(data[start:offset])
+                start = offset
+        offset += len(line)
+
+    if offset > start:
+        chunks.append(data[start:offset])
+
+    return chunks
+
+
+def split_pages(digests):
+    """ Groups the chunk digests of a version into content defined pages
+    """
+    pages = list()
+    page = list()
+    for digest in digests:
+        page.append(digest)
+        if not int(digest[-2:], 16) & PAGE_MASK:
+            pages.append(page)
+            page = list()
+    if page:
+        pages.append(page)
+    return pages
+
+
+class BackupStore(object):
+    """ Content addressed store of configuration backups
+
+    Each configuration is split into chunks at top level statement
+    boundaries and every chunk is stored once, compressed, under its sha1 in
+    ``objects``.  A version is the list of its chunk digests, grouped into
+    pages that are stored as objects as well, so a new version only adds the
+    chunks and pages that changed and unchanged chunks are shared across
+    versions and hosts.
+
+    The versions of each backup name are recorded in ``history/<name>`` and
+    the digest of the latest version in ``heads/<name>``, so storing an
+    unchanged configuration costs a single small read.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.written = 0
+
+    def _object_path(self, digest):
+        return os.path.join(self.path, 'objects', digest[:2], digest[2:])
+
+    def put_object(self, data):
+        digest = hashlib.sha1(data).hexdigest()
+        path = self._object_path(digest)
+        if not os.path.exists(path):
+            write_file(path, zlib.compress(data, 6))
+            self.written += 1
+        return digest
+
+    def get_object(self, digest):
+        with open(self._object_path(digest), 'rb') as f:
+            return zlib.decompress(f.read())
+
+    def head(self, name):
+        try:
+            with open(os.path.join(self.path, 'heads', name), 'rb') as f:
+                return to_text(f.read()).strip()
+        except (IOError, OSError):
+            return None
+
+    def history(self, name):
+        versions = list()
+        try:
+            with open(os.path.join(self.path, 'history', name), 'rb') as f:
+                for line in f:
+                    if line.strip():
+                        versions.append(json.loads(to_text(line)))
+        except (IOError, OSError):
+            pass
+        return versions
+
+    def put(self, name, data):
+        """ Stores a new version of the named configuration
+
+        :param name: The backup name
+        :param data: The configuration as bytes
+
+        :returns: the version record or None if the configuration is
+            unchanged since the latest version
+        """
+        digest = hashlib.sha1(data).hexdigest()
+        if self.head(name) == digest:
+            return None
+
+        chunks = [self.put_object(chunk) for chunk in split_chunks(data)]
+        pages = [self.put_object(to_bytes('\n'.join(page))) for page in split_pages(chunks)]
+        root = self.put_object(to_bytes('\n'.join(pages)))
+
+        history = os.path.join(self.path, 'history', name)
+        version = len(self.history(name)) + 1
+        record = {'version': version, 'timestamp': int(time.time()), 'digest': digest,
+                  'root': root, 'size': len(data)}
+
+        if not os.path.isdir(os.path.dirname(history)):
+            os.makedirs(os.path.dirname(history))
+        with open(history, 'ab') as f:
+            f.write(to_bytes(json.dumps(record, sort_keys=True) + '\n'))
+
+        write_file(os.path.join(self.path, 'heads', name), to_bytes(digest))
+        return record
+
+    def get(self, name, version=None):
+        """ Returns the configuration of a version
+
+        :param name: The backup name
+        :param version: The version number, the latest version if None
+
+        :returns: a tuple of the version record and the configuration bytes
+        """
+        versions = self.history(name)
+        if not versions:
+            raise AnsibleError('no backups found for %s' % name)
+
+        if version is None:
+            record = versions[-1]
+        elif 0 < version <= len(versions):
+            record = versions[version - 1]
+        else:
+            raise AnsibleError('version %s of %s does not exist, the latest version is %s'
+                               % (version, name, len(versions)))
+
+        chunks = list()
+        for page in to_text(self.get_object(record['root'])).split():
+            for chunk in to_text(self.get_object(page)).split():
+                chunks.append(self.get_object(chunk))
+
+        data = b''.join(chunks)
+        if hashlib.sha1(data).hexdigest() != record['digest']:
+            raise AnsibleError('version %s of %s is corrupted' % (record['version'], name))
+
+        return record, data
+
+
+class ActionModule(ActionBase):
+
+    def run(self, tmp=None, task_vars=None):
+        if task_vars is None:
+            task_vars = dict()
+
+        result = super(ActionModule, self).run(tmp, task_vars)
+
+        backup_path = self._task.args.get('backup_path')
+        name = self._task.args.get('name')
+        content = self._task.args.get('content')
+        version = self._task.args.get('version')
+        dest = self._task.args.get('dest')
+
+        if not backup_path or not name:
+            return {'failed': True, 'msg': 'backup_path and name are required'}
+
+        name = to_text(name)
+        if os.sep in name or name.startswith('.'):
+            return {'failed': True, 'msg': 'invalid backup name %s' % name}
+
+        store = BackupStore(os.path.expanduser(backup_path))
+
+        try:
+            if content is None:
+                if version is not None and to_text(version) != 'latest':
+                    version = int(version)
+                else:
+                    version = None
+                record, data = store.get(name, version)
+                result.update(record)
+                result['content'] = to_text(data, errors='surrogate_or_strict')
+                return result
+
+            data = to_bytes(content, errors='surrogate_or_strict')
+            digest = hashlib.sha1(data).hexdigest()
+            if dest:
+                dest = os.path.expanduser(dest)
+
+            if self._play_context.check_mode:
+                result['changed'] = store.head(name) != digest or bool(dest and file_digest(dest) != digest)
+                return result
+
+            record = store.put(name, data)
+            if record is not None:
+                result.update(record)
+                result['changed'] = True
+                result['objects_written'] = store.written
+
+            if dest:
+                # dest is written whenever it differs from the configuration,
+                # so a deleted or edited copy is restored as well
+                if file_digest(dest) != digest:
+                    write_file(dest, data, common.file_mode(dest))
+                    result['changed'] = True
+                result['dest'] = dest
+
+        except (IOError, OSError, ValueError) as exc:
+            return {'failed': True, 'msg': to_text(exc)}
+        except AnsibleError as exc:
+            return {'failed': True, 'msg': to_text(exc)}
+
+        return result
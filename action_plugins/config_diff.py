@@ -0,0 +1,274 @@
+# -*- coding: utf-8 -*-
+
+# (c) 2018, Ansible by Red Hat, inc
+# GNU General Public License v3.0+ (see COPYING or https://www.gnu.org/licenses/gpl-3.0.txt)
+#
+# You should have received a copy of the GNU General Public License
+# along with Ansible.  If not, see <http://www.gnu.org/licenses/>.
+#
+from __future__ import (absolute_import, division, print_function)
+__metaclass__ = type
+
+import os
+import re
+import sys
+import hashlib
+import collections
+
+from ansible.plugins.action import ActionBase
+from ansible.module_utils.network.common.utils import to_list
+from ansible.module_utils.six import iteritems
+from ansible.module_utils._text import to_bytes, to_text
+
+try:
+    from importlib.util import spec_from_file_location, module_from_spec
+except ImportError:
+    import imp
+    spec_from_file_location = None
+
+
+NO_CHILDREN = ()
+
+
+def load_module(name):
+    """ Loads a module of the network_config directory next to the plugins
+
+    The role is not on the python path of the controller, so the code shared
+    by the action plugins is loaded from its file, once per process.
+    """
+    full_name = 'network_config_%s' % name
+    module = sys.modules.get(full_name)
+    if module is not None:
+        return module
+
+    path = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'network_config', '%s.py' % name)
+    if spec_from_file_location is None:
+        return imp.load_source(full_name, path)
+
+    spec = spec_from_file_location(full_name, path)
+    module = module_from_spec(spec)
+    sys.modules[full_name] = module
+    try:
+        spec.loader.exec_module(module)
+    except Exception:
+        del sys.modules[full_name]
+        raise
+    return module
+
+
+common = load_module('common')
+
+
+class ConfigNode(object):
+    """ A configuration line and the lines nested under it
+
+    ``digest`` identifies the line along with its whole subtree, so two
+    subtrees with the same digest are identical.  The children are hashed in
+    document order unless the section is ``unordered``, in which case two
+    sections that only differ in the order of their children have the same
+    digest.
+    """
+
+    __slots__ = ('text', 'raw', 'children', 'unordered', 'digest')
+
+    def __init__(self, text, raw, unordered=False):
+        self.text = text
+        self.raw = raw
+        self.children = NO_CHILDREN
+        self.unordered = unordered
+        self.digest = None
+
+    def add_child(self, text, raw, unordered=False):
+        if self.children is NO_CHILDREN:
+            self.children = list()
+        node = ConfigNode(text, raw, unordered)
+        self.children.append(node)
+        return node
+
+    def seal(self):
+        digests = [c.digest for c in self.children]
+        if self.unordered:
+            digests.sort()
+        data = to_bytes(u'%s\n%s' % (self.text, ','.join(digests)), errors='surrogate_or_strict')
+        self.digest = hashlib.sha1(data).hexdigest()
+
+    def keyed_children(self):
+        """ Returns the children keyed by their text and occurrence
+
+        A line repeated under the same parent is keyed by its text and the
+        number of times it appeared before, so repeated lines are matched
+        in document order.
+        """
+        children = collections.OrderedDict()
+        seen = collections.defaultdict(int)
+        for child in self.children:
+            children[(child.text, seen[child.text])] = child
+            seen[child.text] += 1
+        return children
+
+    def dump(self):
+        """ Returns the raw lines of the subtree in document order
+        """
+        lines = [self.raw]
+        for child in self.children:
+            lines.extend(child.dump())
+        return lines
+
+
+def parse_config(contents, unordered=()):
+    """ Parses the configuration into a tree of ConfigNode in a single pass
+
+    The hierarchy is the one of ``iter_config_lines()`` in the shared
+    ``common`` module, so it follows the same rules as the ``config_parser``
+    section index: it is based on indentation and sections opened with
+    ``{`` are only closed by the matching ``}``.  Comments and bare braces
+    are ignored.
+
+    :param contents: The configuration text
+    :param unordered: The list of compiled regular expressions matching the
+        sections whose children are compared regardless of their order
+
+    :returns: the root ConfigNode, which has no text of its own
+    """
+    def is_unordered(text):
+        return any(regex.search(text) for regex in unordered)
+
+    root = ConfigNode(u'', u'', is_unordered(u''))
+    stack = [root]
+
+    lines = (line.rstrip('\r') for line in to_text(contents, errors='surrogate_or_strict').split('\n'))
+    for line, stripped, depth in common.iter_config_lines(lines):
+        while len(stack) > depth + 1:
+            stack.pop().seal()
+        stack.append(stack[-1].add_child(stripped, line, is_unordered(stripped)))
+
+    while stack:
+        stack.pop().seal()
+
+    return root
+
+
+def moved_children(candidate, running):
+    """ Returns the keys of the children whose relative order has changed
+
+    Devices append the lines added to a section, so once a child found in
+    both sections comes before one that precedes it in running, or comes
+    after a child that is missing from running, that child and every common
+    child after it have to be removed and added again to get the candidate
+    order.
+
+    :param candidate: The keyed children of the intended section
+    :param running: The keyed children of the section to compare to
+
+    :returns: set of child keys
+    """
+    positions = dict((key, index) for index, key in enumerate(running))
+    shared = [key for key in candidate if key in positions]
+
+    last = -1
+    added = False
+    index = 0
+    for key in candidate:
+        if key not in positions:
+            added = True
+            continue
+        if added or positions[key] < last:
+            return set(shared[index:])
+        last = positions[key]
+        index += 1
+    return set()
+
+
+def diff_config(candidate, running):
+    """ Returns the lines that differ between candidate and running
+
+    Subtrees with the same digest are skipped without being walked.  Lines
+    are returned along with the parent lines they are nested under.  Lines
+    that are in both sections but out of order, or that follow a line
+    missing from running, are returned with their subtree in both lists, so
+    the section is reordered by removing and adding them again.  The order
+    of the children of unordered sections is ignored.
+
+    :param candidate: The root ConfigNode of the intended configuration
+    :param running: The root ConfigNode of the configuration to compare to
+
+    :returns: tuple of the lines missing from running in the candidate
+        order and the lines missing from candidate in the running order
+    """
+    updates = list()
+    removed = list()
+
+    ours = candidate.keyed_children()
+    theirs = running.keyed_children()
+
+    moved = set()
+    if not candidate.unordered:
+        moved = moved_children(ours, theirs)
+
+    nested = dict()
+    for key, node in iteritems(ours):
+        other = theirs.get(key)
+        if other is None or key in moved:
+            updates.extend(node.dump())
+        elif other.digest != node.digest:
+            nested[key] = child_updates, child_removed = diff_config(node, other)
+            if child_updates:
+                updates.append(node.raw)
+                updates.extend(child_updates)
+
+    for key, node in iteritems(theirs):
+        if key not in ours or key in moved:
+            removed.extend(node.dump())
+        elif key in nested and nested[key][1]:
+            removed.append(node.raw)
+            removed.extend(nested[key][1])
+
+    return updates, removed
+
+
+class ActionModule(ActionBase):
+
+    def run(self, tmp=None, task_vars=None):
+        if task_vars is None:
+            task_vars = dict()
+
+        result = super(ActionModule, self).run(tmp, task_vars)
+
+        try:
+            candidate = self._load('candidate')
+            running = self._load('running')
+            unordered = [re.compile(r) for r in to_list(self._task.args.get('unordered_sections'))]
+        except re.error as exc:
+            return {'failed': True, 'msg': 'invalid unordered_sections expression: %s' % to_text(exc)}
+        except (IOError, OSError, ValueError) as exc:
+            return {'failed': True, 'msg': to_text(exc)}
+
+        updates = removed = list()
+
+        # identical text needs neither tree to be built
+        if to_text(candidate, errors='surrogate_or_strict') != to_text(running, errors='surrogate_or_strict'):
+            candidate = parse_config(candidate, unordered)
+            running = parse_config(running, unordered)
+
+            if candidate.digest != running.digest:
+                updates, removed = diff_config(candidate, running)
+
+        result.update({
+            'changed': bool(updates or removed),
+            'updates': updates,
+            'removed': removed,
+        })
+        return result
+
+    def _load(self, name):
+        """ Returns the configuration from the name or name_file argument
+        """
+        value = self._task.args.get(name)
+        path = self._task.args.get('%s_file' % name)
+
+        if (value is None) == (path is None):
+            raise ValueError('exactly one of %s or %s_file is required' % (name, name))
+        elif path is not None:
+            with open(os.path.expanduser(path), 'rb') as f:
+                return f.read()
+        return value
@@ -0,0 +1,230 @@
+# -*- coding: utf-8 -*-
+
+# (c) 2018, Ansible by Red Hat, inc
+# GNU General Public License v3.0+ (see COPYING or https://www.gnu.org/licenses/gpl-3.0.txt)
+#
+# You should have received a copy of the GNU General Public License
+# along with Ansible.  If not, see <http://www.gnu.org/licenses/>.
+#
+from __future__ import (absolute_import, division, print_function)
+__metaclass__ = type
+
+import os
+import sys
+import time
+import collections
+
+from ansible import constants as C
+from ansible.plugins.action import ActionBase
+from ansible.module_utils._text import to_text
+from ansible.module_utils.parsing.convert_bool import boolean
+from ansible.errors import AnsibleError
+
+try:
+    from importlib.util import spec_from_file_location, module_from_spec
+except ImportError:
+    import imp
+    spec_from_file_location = None
+
+try:
+    from __main__ import display
+except ImportError:
+    from ansible.utils.display import Display
+    display = Display()
+
+
+# the search path for the provider tasks, the same order as tasks/get.yaml
+PROVIDER_PATHS = (
+    '{playbook_dir}/providers/{network_os}/network-config',
+    '{role_path}/providers/{network_os}',
+    '/etc/ansible/network/{network_os}/network-config',
+)
+
+DEFAULT_CONCURRENCY = 50
+
+Target = collections.namedtuple('Target', ['name', 'host', 'port', 'username', 'password',
+                                           'private_key', 'command', 'path', 'become', 'mode'])
+
+
+def warning(msg):
+    if C.ACTION_WARNINGS:
+        display.warning(msg)
+
+
+def load_module(name):
+    """ Loads a module of the network_config directory next to the plugins
+
+    The role is not on the python path of the controller, so the code shared
+    by the action plugins is loaded from its file, once per process.
+    """
+    full_name = 'network_config_%s' % name
+    module = sys.modules.get(full_name)
+    if module is not None:
+        return module
+
+    path = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'network_config', '%s.py' % name)
+    if spec_from_file_location is None:
+        return imp.load_source(full_name, path)
+
+    spec = spec_from_file_location(full_name, path)
+    module = module_from_spec(spec)
+    sys.modules[full_name] = module
+    try:
+        spec.loader.exec_module(module)
+    except Exception:
+        del sys.modules[full_name]
+        raise
+    return module
+
+
+common = load_module('common')
+
+
+# the fetch coroutines use the python 3 syntax and are kept in their own
+# module so this plugin can still be loaded on python 2
+try:
+    if sys.version_info < (3, 5):
+        raise ImportError('python 3.5 or later is required')
+    import asyncio
+    fetch = load_module('fetch')
+    HAS_ASYNCSSH = True
+except ImportError:
+    HAS_ASYNCSSH = False
+
+
+class ActionModule(ActionBase):
+
+    _provider_commands = None
+
+    def run(self, tmp=None, task_vars=None):
+        if task_vars is None:
+            task_vars = dict()
+
+        result = super(ActionModule, self).run(tmp, task_vars)
+
+        if not HAS_ASYNCSSH:
+            return {'failed': True, 'msg': 'the config_fetch action requires python 3 and the asyncssh library'}
+
+        dest = self._task.args.get('dest')
+        if not dest:
+            return {'failed': True, 'msg': 'missing required argument: dest'}
+
+        dest = os.path.expanduser(dest)
+        if not os.path.isdir(dest):
+            return {'failed': True, 'msg': 'destination directory %s does not exist' % dest}
+
+        try:
+            concurrency = int(self._task.args.get('concurrency') or DEFAULT_CONCURRENCY)
+            timeout = self._task.args.get('timeout')
+            timeout = int(timeout) if timeout else None
+        except (TypeError, ValueError):
+            return {'failed': True, 'msg': 'concurrency and timeout must be integer values'}
+
+        hosts = self._task.args.get('hosts') or task_vars.get('ansible_play_hosts') or list()
+
+        self._provider_commands = dict()
+        targets = list()
+        rejected = dict()
+        for host in hosts:
+            # a host that can not be fetched from is reported on its own,
+            # the others are still fetched
+            try:
+                target = self._target(host, task_vars, dest)
+            except AnsibleError as exc:
+                rejected[host] = {'failed': True, 'path': self._path(host, dest), 'msg': to_text(exc)}
+                continue
+
+            if target.become:
+                # the get task enters the privileged mode first, which
+                # can not be done over an exec channel
+                rejected[host] = {'failed': True, 'path': target.path,
+                                  'msg': 'the configuration of %s is retrieved with become, which is not '
+                                         'supported by config_fetch, use the get task instead' % host}
+            else:
+                targets.append(target)
+
+        known_hosts = () if C.HOST_KEY_CHECKING else None
+
+        started = time.time()
+        loop = asyncio.new_event_loop()
+        try:
+            hosts = loop.run_until_complete(fetch.fetch_all(targets, concurrency, known_hosts, timeout))
+        finally:
+            loop.close()
+        hosts.update(rejected)
+
+        failed = sorted(name for name, res in hosts.items() if res.get('failed'))
+        for name in failed:
+            warning('unable to fetch the configuration from %s: %s' % (name, hosts[name]['msg']))
+
+        result.update({
+            'changed': len(failed) < len(hosts),
+            'hosts': hosts,
+            'failed_hosts': failed,
+            'elapsed': round(time.time() - started, 3),
+        })
+        return result
+
+    def _target(self, name, task_vars, dest):
+        hostvars = task_vars.get('hostvars', {}).get(name) or dict()
+
+        command = self._task.args.get('command')
+        become = boolean(hostvars.get('ansible_become', False), strict=False)
+        if not command:
+            network_os = hostvars.get('ansible_network_os')
+            if not network_os:
+                raise AnsibleError('ansible_network_os is not set for %s' % name)
+            command, provider_become = self._provider_command(network_os, task_vars)
+            become = become or provider_become
+
+        password = hostvars.get('ansible_password', hostvars.get('ansible_ssh_pass'))
+        path = self._path(name, dest)
+
+        return Target(
+            name=name,
+            host=hostvars.get('ansible_host', name),
+            port=int(hostvars.get('ansible_port') or 22),
+            username=hostvars.get('ansible_user'),
+            password=password,
+            private_key=hostvars.get('ansible_ssh_private_key_file'),
+            command=command,
+            path=path,
+            become=become,
+            mode=common.file_mode(path),
+        )
+
+    def _path(self, name, dest):
+        return os.path.join(dest, '%s%s' % (name, self._task.args.get('suffix') or ''))
+
+    def _provider_command(self, network_os, task_vars):
+        """ Returns the command the provider get tasks run for network_os
+
+        The command is taken from the ``cli_get`` task of the first
+        ``get.yaml`` found in the provider search path.
+
+        :returns: tuple of the command and whether the task uses become
+        """
+        if network_os in self._provider_commands:
+            if self._provider_commands[network_os] is None:
+                raise AnsibleError('unable to find the get command for network os %s' % network_os)
+            return self._provider_commands[network_os]
+
+        role_path = task_vars.get('role_path') or os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+        values = {'network_os': network_os,
+                  'playbook_dir': task_vars.get('playbook_dir', ''),
+                  'role_path': role_path}
+
+        for path in PROVIDER_PATHS:
+            path = os.path.join(path.format(**values), 'get.yaml')
+            if not os.path.isfile(path):
+                continue
+            for task in self._loader.load_from_file(path) or list():
+                command = (task.get('cli_get') or dict()).get('command')
+                if command:
+                    become = boolean(task.get('become', False), strict=False)
+                    self._provider_commands[network_os] = (to_text(command), become)
+                    return self._provider_commands[network_os]
+            break
+
+        self._provider_commands[network_os] = None
+        raise AnsibleError('unable to find the get command for network os %s' % network_os)
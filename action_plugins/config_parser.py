@@ -5,17 +5,43 @@
 # along with Ansible.  If not, see <http://www.gnu.org/licenses/>.
 import os
 import re
-import copy
+import sys
 import json
+import time
+import pickle
+import hashlib
+import tempfile
 import collections
 
+from jinja2 import Undefined
+
+try:
+    from re import _parser as sre_parse
+except ImportError:
+    import sre_parse
+
+try:
+    from importlib.util import spec_from_file_location, module_from_spec
+except ImportError:
+    import imp
+    spec_from_file_location = None
+
 from ansible import constants as C
 from ansible.plugins.action import ActionBase
-from ansible.module_utils.network.common.utils import to_list, dict_merge
-from ansible.module_utils.network.common.config import NetworkConfig
-from ansible.module_utils.six import iteritems, string_types
+from ansible.module_utils.network.common.utils import to_list
+from ansible.module_utils.six import iteritems, integer_types, string_types
 from ansible.module_utils._text import to_bytes, to_text
-from ansible.errors import AnsibleError, AnsibleUndefinedVariable, AnsibleFileNotFound
+from ansible.module_utils.parsing.convert_bool import boolean
+from ansible.errors import AnsibleError, AnsibleUndefinedVariable
+
+# the compat module is only shipped with ansible 2.8 and later
+try:
+    from ansible.module_utils.common._collections_compat import Iterable, Mapping
+except ImportError:
+    try:
+        from collections.abc import Iterable, Mapping
+    except ImportError:
+        from collections import Iterable, Mapping
 
 try:
     from __main__ import display
@@ -29,7 +55,535 @@ def warning(msg):
         display.warning(msg)
 
 
-import q
+def load_module(name):
+    """ Loads a module of the network_config directory next to the plugins
+
+    The role is not on the python path of the controller, so the code shared
+    by the action plugins is loaded from its file, once per process.
+    """
+    full_name = 'network_config_%s' % name
+    module = sys.modules.get(full_name)
+    if module is not None:
+        return module
+
+    path = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'network_config', '%s.py' % name)
+    if spec_from_file_location is None:
+        return imp.load_source(full_name, path)
+
+    spec = spec_from_file_location(full_name, path)
+    module = module_from_spec(spec)
+    sys.modules[full_name] = module
+    try:
+        spec.loader.exec_module(module)
+    except Exception:
+        del sys.modules[full_name]
+        raise
+    return module
+
+
+common = load_module('common')
+
+
+# compiled parsers are cached for the lifetime of the process and are keyed
+# by the parser path.  the cached parser is reused as long as the file mtime
+# or, failing that, the content hash is unchanged
+_PARSER_CACHE = dict()
+
+ParserPlan = collections.namedtuple('ParserPlan', ['path', 'mtime', 'digest', 'entries', 'tag_index'])
+
+ParserEntry = collections.namedtuple('ParserEntry', ['name', 'tags', 'section', 'matches', 'scanner', 'facts', 'loop'])
+
+Match = collections.namedtuple('Match', ['regex', 'match_all', 'match_var', 'literal'])
+
+# the facts of each entry are compiled into a skeleton of these nodes.  keys
+# and values without a template are resolved at compile time, values that
+# only reference a variable such as ``{{ name.0 }}`` carry the compiled
+# (name, path) reference so they can be filled without the templar.  convert
+# is applied to every templated value, either the declared type or the
+# legacy type guess
+StaticFact = collections.namedtuple('StaticFact', ['value'])
+TemplateFact = collections.namedtuple('TemplateFact', ['value', 'reference', 'convert'])
+DictFact = collections.namedtuple('DictFact', ['items'])
+ListFact = collections.namedtuple('ListFact', ['items'])
+
+# patterns are only prefiltered when they require a literal of at least
+# this length, shorter literals do not save enough to pay for the scan
+MIN_LITERAL_LENGTH = 3
+
+
+def required_literal(pattern):
+    """Returns the longest literal string the pattern requires to match
+
+    Only the top level of the pattern is considered so every literal found
+    must appear in any text the pattern matches.  Returns None when the
+    pattern is case insensitive or has no literal long enough to be useful.
+    """
+    try:
+        parsed = sre_parse.parse(pattern)
+    except Exception:
+        return None
+
+    state = getattr(parsed, 'state', None) or parsed.pattern
+    if state.flags & (re.I | re.X):
+        return None
+
+    best = _longest_literal(parsed)
+    if len(best) >= MIN_LITERAL_LENGTH:
+        return best
+
+
+def _longest_literal(parsed):
+    best = current = ''
+    for op, value in parsed:
+        if op == sre_parse.LITERAL:
+            current += chr(value)
+            continue
+
+        best = max(best, current, key=len)
+        current = ''
+
+        # groups are required as a whole unless they change the flags
+        if op == sre_parse.SUBPATTERN and (len(value) == 2 or not any(value[1:3])):
+            best = max(best, _longest_literal(value[-1]), key=len)
+
+    return max(best, current, key=len)
+
+
+class LiteralScanner(object):
+    """Finds which of a set of literals appear in a text with one scan
+
+    The literals are combined into a single zero width alternation that is
+    tried at every position of the text, longest literal first.  A literal
+    that is a prefix of a longer one found at the same position is implied
+    by it, so every literal present in the text is reported.
+    """
+
+    def __init__(self, literals):
+        literals = sorted(set(literals), key=len, reverse=True)
+        self.regex = re.compile('(?=(%s))' % '|'.join(re.escape(literal) for literal in literals))
+        self.implied = dict()
+        for literal in literals:
+            self.implied[literal] = frozenset(prefix for prefix in literals if literal.startswith(prefix))
+
+    def scan(self, text):
+        found = set()
+        for literal in set(m.group(1) for m in self.regex.finditer(text)):
+            found.update(self.implied[literal])
+        return found
+
+
+def coerce_to_native(value):
+    """Guesses the type of a fact value that has no declared type
+
+    Values that can be converted to int are returned as int and empty
+    values are returned as None.
+    """
+    if value is None:
+        return None
+    if not isinstance(value, bool):
+        try:
+            value = int(value)
+        except:
+            if len(value) == 0:
+                return None
+            pass
+    return value
+
+
+def _to_int(value):
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def _to_bool(value):
+    if value is not None:
+        return boolean(value, strict=False)
+
+
+def _to_str(value):
+    if value is not None:
+        return to_text(value)
+
+
+def _to_ipaddr(value):
+    # the ipaddress module is large and only needed by parsers that declare
+    # the ipaddr type, so it is imported on first use
+    from ansible.module_utils.compat import ipaddress
+    try:
+        ipaddress.ip_interface(to_text(value))
+    except ValueError:
+        return None
+    return to_text(value)
+
+
+# the types that can be declared for fact values in the entry ``types``
+FACT_TYPES = {
+    'int': _to_int,
+    'bool': _to_bool,
+    'list': to_list,
+    'str': _to_str,
+    'ipaddr': _to_ipaddr,
+}
+
+
+def compile_reference(value, environment):
+    """Returns the (name, path) reference if value only references a variable
+
+    The reference is compiled by common.compile_line() for expressions such
+    as ``{{ name.0 }}`` or ``{{ item['name'] }}``.  Returns None for any
+    other template.
+    """
+    parts = common.compile_line(value, environment)
+    if parts is not None and len(parts) == 1 and not isinstance(parts[0], string_types):
+        return parts[0]
+
+
+def compile_facts(data, environment, types, path=()):
+    """Compiles the facts of an entry into a skeleton of fact nodes
+
+    :param data: The facts structure from the parser file
+    :param environment: The jinja2 environment used to parse templates
+    :param types: A list of (path, convert) tuples of the declared types
+    :param path: The path of data in the facts
+
+    :returns: the root node of the skeleton
+    """
+    if isinstance(data, Mapping):
+        items = list()
+        for key, value in iteritems(data):
+            key_node = compile_facts(key, environment, ())
+            segment = '*' if isinstance(key_node, TemplateFact) else to_text(key)
+            items.append((key_node, compile_facts(value, environment, types, path + (segment,))))
+        return DictFact(tuple(items))
+
+    elif isinstance(data, Iterable) and not isinstance(data, string_types):
+        return ListFact(tuple(compile_facts(i, environment, types, path + ('*',)) for i in data))
+
+    convert = coerce_to_native
+    for type_path, type_convert in types:
+        if len(type_path) == len(path) and all(t in ('*', p) for t, p in zip(type_path, path)):
+            convert = type_convert
+
+    if common.is_template(data, environment):
+        return TemplateFact(data, compile_reference(data, environment), convert)
+    elif convert is coerce_to_native:
+        return StaticFact(coerce_to_native(data or {}))
+    else:
+        return StaticFact(convert(data))
+
+
+def compile_parser(contents, environment):
+    """Compiles the parser file contents into a list of ParserEntry
+    """
+    entries = list()
+
+    for entry in contents:
+        name = entry.get('name')
+
+        try:
+            section = entry.get('section')
+            if section:
+                section = re.compile(section, re.I)
+
+            matches = list()
+            for match in entry['matches']:
+                match_all = match.get('match_all', False)
+                regex = re.compile(match['pattern'], 0 if match_all else re.M)
+                literal = required_literal(match['pattern'])
+                matches.append(Match(regex, match_all, match.get('match_var'), literal))
+        except re.error as exc:
+            raise AnsibleError('invalid pattern in `%s`: %s' % (name, to_text(exc)))
+
+        literals = [m.literal for m in matches if m.literal]
+        scanner = LiteralScanner(literals) if literals else None
+
+        types = list()
+        for type_path, type_name in iteritems(entry.get('types') or {}):
+            if type_name not in FACT_TYPES:
+                raise AnsibleError('invalid type `%s` for `%s` in `%s`, expected one of %s'
+                                   % (type_name, type_path, name, ', '.join(sorted(FACT_TYPES))))
+            types.append((tuple(to_text(type_path).split('.')), FACT_TYPES[type_name]))
+
+        facts = compile_facts(entry['facts'], environment, types)
+
+        tags = frozenset(to_text(t) for t in to_list(entry.get('tags')))
+
+        entries.append(ParserEntry(name, tags, section, tuple(matches),
+                                   scanner, facts, entry.get('loop')))
+
+    return entries
+
+
+def index_tags(entries):
+    """Returns a dict of each tag to the offsets of the entries that have it
+    """
+    tag_index = dict()
+    for index, entry in enumerate(entries):
+        for tag in entry.tags:
+            tag_index.setdefault(tag, list()).append(index)
+    return tag_index
+
+
+def iter_sections(lines):
+    """Yields the top level statements of the config as they are completed
+
+    The lines are consumed in a single pass and each top level statement is
+    yielded as a ``(lines, sections)`` tuple as soon as the next one starts.
+    ``lines`` holds the lines of the statement that are not comments or bare
+    braces and ``sections`` the ``(header, start, end)`` tuples of every
+    section in the statement in document order, where ``start`` and ``end``
+    are offsets in ``lines``.
+
+    The hierarchy is the one of ``iter_config_lines()`` in the shared
+    ``common`` module, which the ``config_diff`` plugin uses as well.
+
+    :param lines: An iterable of configuration lines without line endings
+    """
+    kept = list()
+    sections = list()
+
+    # each frame is [header, start]
+    stack = list()
+
+    def close(frame):
+        if len(kept) - frame[1] > 1:
+            sections.append((frame[1], len(kept), frame[0]))
+
+    def statement():
+        sections.sort()
+        return kept, [(header, start, end) for start, end, header in sections]
+
+    for line, stripped, depth in common.iter_config_lines(lines):
+        while len(stack) > depth:
+            close(stack.pop())
+
+        if not stack and kept:
+            yield statement()
+            kept = list()
+            sections = list()
+
+        stack.append([stripped, len(kept)])
+        kept.append(line)
+
+    while stack:
+        close(stack.pop())
+
+    if kept:
+        yield statement()
+
+
+def format_block(lines):
+    """Returns the text of a section the same way as
+    ``NetworkConfig.get_block_config()`` formats it
+    """
+    return '\n'.join(lines + ['end'])
+
+
+class SectionIndex(object):
+    """Index of the configuration sections found in device output
+
+    Every line that is not a comment or a bare brace is kept in ``lines`` and
+    every section is recorded in ``sections`` as a ``(header, start, end)``
+    tuple in document order, where ``start`` and ``end`` are the offsets of
+    the section in ``lines``.
+    """
+
+    def __init__(self, contents):
+        self.lines = list()
+        self.sections = list()
+
+        for lines, sections in iter_sections(to_text(contents, errors='surrogate_or_strict').split('\n')):
+            offset = len(self.lines)
+            self.lines.extend(lines)
+            self.sections.extend((header, start + offset, end + offset) for header, start, end in sections)
+
+    def find(self, regex):
+        """Returns the offsets of the sections whose header matches regex
+
+        The result is cached by pattern since several parser entries
+        usually share the same section.
+        """
+        cache = self.__dict__.setdefault('_found', dict())
+        key = (regex.pattern, regex.flags)
+        if key not in cache:
+            cache[key] = [(start, end) for header, start, end in self.sections if regex.match(header)]
+        return cache[key]
+
+    def get_block(self, start, end):
+        """Returns the text of the section at the given offsets
+        """
+        return format_block(self.lines[start:end])
+
+
+def _freeze(value):
+    """Returns a hashable representation of value used to dedupe list items
+    """
+    if isinstance(value, Mapping):
+        return frozenset((k, _freeze(v)) for k, v in iteritems(value))
+    elif isinstance(value, list):
+        return tuple(_freeze(v) for v in value)
+    try:
+        hash(value)
+    except TypeError:
+        return repr(value)
+    return value
+
+
+class FactBuilder(object):
+    """Merges fact objects into a single dict in place
+
+    Each merge only walks the object being merged, so building the facts
+    costs time linear in the number of merged objects.  The merge rules
+    are:
+
+    * dicts are merged recursively
+    * lists are extended with the items they do not already contain, in
+      the order the items are merged
+    * any other value, including None, replaces the existing value
+
+    Containers taken from a merged object are copied, so later merges never
+    modify the objects passed in.
+    """
+
+    def __init__(self):
+        self.facts = dict()
+
+        # the items already in each extended list, keyed by the list id.  the
+        # list is held along with its items so the id can not be reused
+        self._seen = dict()
+
+    def merge(self, obj):
+        self._merge(self.facts, obj)
+
+    def _merge(self, base, other):
+        for key, value in iteritems(other):
+            current = base.get(key)
+            if isinstance(value, Mapping) and isinstance(current, dict):
+                self._merge(current, value)
+            elif isinstance(value, list) and isinstance(current, list):
+                self._extend(current, value)
+            else:
+                base[key] = self._copy(value)
+
+    def _extend(self, base, items):
+        entry = self._seen.get(id(base))
+        if entry is None:
+            entry = self._seen[id(base)] = (base, set(_freeze(i) for i in base))
+        seen = entry[1]
+
+        for item in items:
+            key = _freeze(item)
+            if key not in seen:
+                seen.add(key)
+                base.append(self._copy(item))
+
+    def _copy(self, value):
+        if isinstance(value, Mapping):
+            return dict((k, self._copy(v)) for k, v in iteritems(value))
+        elif isinstance(value, list):
+            return [self._copy(v) for v in value]
+        return value
+
+
+# bump the version whenever the format of the cached facts or the parsing
+# rules change so facts cached by older versions are never reused
+FACTS_CACHE_VERSION = 1
+
+# minimum number of seconds between two eviction scans of the cache directory
+FACTS_CACHE_EVICT_INTERVAL = 60
+
+
+class FactsCache(object):
+    """ On disk cache of parsed facts
+
+    The facts are stored as one pickle file per key, where the key is a hash
+    of the command output, the parser file, the selected tags and whether
+    the output was streamed, since patterns that span several lines do not
+    match when streaming, so the same output parsed by the same parser is
+    only ever parsed once.  The cache is
+    shared by all hosts.  Files that have not been used for more than
+    ``max_age`` seconds are evicted, as are the least recently used files
+    once the cache grows larger than ``max_size`` bytes.
+    """
+
+    def __init__(self, path, max_age=None, max_size=None):
+        self.path = path
+        self.max_age = max_age
+        self.max_size = max_size
+
+    def key(self, digest, plan, tags, stream):
+        data = json.dumps([FACTS_CACHE_VERSION, digest, plan.digest, tags, stream], sort_keys=True)
+        return hashlib.sha1(to_bytes(data, errors='surrogate_or_strict')).hexdigest()
+
+    def get(self, key):
+        path = os.path.join(self.path, key)
+        try:
+            if self.max_age and time.time() - os.stat(path).st_mtime > self.max_age:
+                return None
+            with open(path, 'rb') as f:
+                data = pickle.load(f)
+            if data.get('version') != FACTS_CACHE_VERSION:
+                return None
+            os.utime(path, None)
+        except (IOError, OSError, EOFError, ValueError, TypeError, AttributeError, pickle.UnpicklingError):
+            return None
+        return data['facts']
+
+    def set(self, key, facts):
+        if not os.path.isdir(self.path):
+            os.makedirs(self.path)
+        fd, tmp_path = tempfile.mkstemp(dir=self.path, prefix='.facts.')
+        with os.fdopen(fd, 'wb') as f:
+            pickle.dump({'version': FACTS_CACHE_VERSION, 'facts': facts}, f, 2)
+        os.rename(tmp_path, os.path.join(self.path, key))
+        self.evict()
+
+    def evict(self):
+        """ Removes the expired files and the least recently used files
+        over the size limit
+
+        The directory is scanned at most once per eviction interval across
+        all the processes sharing the cache.
+        """
+        if not self.max_age and not self.max_size:
+            return
+
+        marker = os.path.join(self.path, '.evicted')
+        now = time.time()
+        try:
+            if now - os.stat(marker).st_mtime < FACTS_CACHE_EVICT_INTERVAL:
+                return
+        except OSError:
+            pass
+        with open(marker, 'w'):
+            pass
+
+        files = list()
+        for name in os.listdir(self.path):
+            if name.startswith('.'):
+                continue
+            path = os.path.join(self.path, name)
+            try:
+                st = os.stat(path)
+            except OSError:
+                continue
+            files.append((st.st_mtime, st.st_size, path))
+
+        files.sort(reverse=True)
+        total = 0
+        for mtime, size, path in files:
+            total += size
+            if (self.max_age and now - mtime > self.max_age) or (self.max_size and total > self.max_size):
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+
+
+_SHARED_PLANS = common.SharedCache('config_parser')
+
 
 class ActionModule(ActionBase):
 
@@ -40,104 +594,413 @@ class ActionModule(ActionBase):
         result = super(ActionModule, self).run(tmp, task_vars)
 
         src = self._task.args['src']
-        output = self._task.args['output']
-        tags = self._task.args.get('tags')
+        output = self._task.args.get('output')
+        output_file = self._task.args.get('output_file')
+        outputs = self._task.args.get('outputs')
+        output_dir = self._task.args.get('output_dir')
+        tags = sorted(set(to_text(t) for t in to_list(self._task.args.get('tags'))))
+
+        provided = [arg for arg in (output, output_file, outputs, output_dir) if arg is not None]
+        if len(provided) != 1:
+            return {'failed': True, 'msg': 'exactly one of output, output_file, outputs or output_dir is required'}
+
+        try:
+            workers = int(self._task.args.get('workers') or 1)
+        except (TypeError, ValueError):
+            return {'failed': True, 'msg': 'workers must be an integer value'}
+
+        cache = None
+        cache_dir = self._task.args.get('cache_dir')
+        if cache_dir:
+            try:
+                max_age = int(self._task.args.get('cache_max_age') or 0)
+                max_size = int(self._task.args.get('cache_max_size') or 0)
+            except (TypeError, ValueError):
+                return {'failed': True, 'msg': 'cache_max_age and cache_max_size must be integers'}
+            cache = FactsCache(os.path.expanduser(cache_dir), max_age, max_size)
 
         try:
             parser = self._find_needle('parsers', src)
         except AnsibleError as exc:
             return {'failed': True, 'msg': to_text(exc)}
 
-        template = self._loader.load_from_file(parser)
+        try:
+            plan = self._load_parser(parser)
+        except AnsibleError as exc:
+            return {'failed': True, 'msg': to_text(exc)}
+
+        self._section_index = None
+
+        entries = self.select_entries(plan, tags)
+
+        if outputs is not None or output_dir is not None:
+            try:
+                sources = self._batch_sources(outputs, output_dir, task_vars)
+            except AnsibleError as exc:
+                return {'failed': True, 'msg': to_text(exc)}
+
+            hosts = self.parse_hosts(sources, entries, workers, cache, plan, tags)
 
-        network_config = NetworkConfig(contents=output, indent=3)
-        sections = set()
-        for entry in network_config.items:
-            for p in entry.parents:
-                sections.add(p)
+            failed = sorted(host for host, res in iteritems(hosts) if res.get('failed'))
+            for host in failed:
+                warning('unable to parse the output of %s: %s' % (host, hosts[host]['msg']))
 
-        setattr(self, 'network_config', network_config)
-        setattr(self, 'sections', sections)
+            result.update({'hosts': hosts, 'failed_hosts': failed})
+            return result
 
-        result['ansible_facts'] = self.parse(output, template, tags)
+        if output_file is not None:
+            output_file = os.path.expanduser(output_file)
+
+        try:
+            facts = self._cached_parse(cache, plan, tags, output, output_file, entries, workers)
+        except (IOError, OSError) as exc:
+            return {'failed': True, 'msg': to_text(exc)}
+
+        result['ansible_facts'] = facts
         return result
 
-    def parse(self, source, template, tags):
-        templated_facts = {}
-        for entry in template:
-            name = entry.get('name')
-            entry_tags = entry.get('tags')
+    def select_entries(self, plan, tags):
+        """Returns the parser entries selected by tags in file order
+
+        When tags are provided, only the entries that have at least one of
+        the tags are selected.
+        """
+        if not tags:
+            return plan.entries
 
-            if tags and tags != entry_tags:
-                warning('skipping `%s` due to tagging' % name)
+        selected = set()
+        for tag in tags:
+            selected.update(plan.tag_index.get(tag, ()))
+
+        if not selected:
+            warning('no parser entries match tags %s' % ', '.join(tags))
+        else:
+            display.vvv('%d of %d parser entries selected by tags' % (len(selected), len(plan.entries)))
+
+        return [plan.entries[index] for index in sorted(selected)]
+
+    def _batch_sources(self, outputs, output_dir, task_vars):
+        """Returns the list of (host, output, output_file) tuples to parse
+
+        The outputs are either provided directly as a mapping of host to
+        output or read from the ``<host><suffix>`` files in output_dir, the
+        same files config_fetch writes.
+        """
+        if outputs is not None:
+            if not isinstance(outputs, Mapping):
+                raise AnsibleError('outputs must be a mapping of host to output')
+            return [(to_text(host), to_text(output), None) for host, output in sorted(iteritems(outputs))]
+
+        output_dir = os.path.expanduser(output_dir)
+        if not os.path.isdir(output_dir):
+            raise AnsibleError('output directory %s does not exist' % output_dir)
+
+        hosts = to_list(self._task.args.get('hosts') or task_vars.get('ansible_play_hosts'))
+        suffix = self._task.args.get('suffix') or ''
+        return [(to_text(host), None, os.path.join(output_dir, '%s%s' % (host, suffix))) for host in hosts]
+
+    def parse_hosts(self, sources, entries, workers=1, cache=None, plan=None, tags=None):
+        """Parses the output of many hosts with the same parser entries
+
+        The entries are compiled once for all the hosts.  If more than one
+        worker is requested, the hosts are parsed by a pool of worker
+        processes, one host at a time per worker.  The output files are read
+        whole and parsed like an output, not streamed, so the facts do not
+        depend on where the output comes from.  A failure to read the output
+        of a host does not affect the others.
+
+        :param sources: list of (host, output, output_file) tuples
+        :param entries: The list of ParserEntry to apply
+        :param workers: The number of processes to parse with
+        :param cache: A FactsCache to look the facts up in or None
+
+        :returns: dict of the result of each host keyed by host
+        """
+        results = dict()
+        pending = list()
+        keys = dict()
+        for source in sources:
+            if cache is None:
+                pending.append(source)
                 continue
+            host, output, output_file = source
+            try:
+                keys[host] = cache.key(self._output_digest(output, output_file), plan, tags, False)
+            except (IOError, OSError) as exc:
+                results[host] = {'failed': True, 'msg': to_text(exc)}
+                continue
+            facts = cache.get(keys[host])
+            if facts is None:
+                pending.append(source)
+            else:
+                results[host] = {'ansible_facts': facts}
 
-            facts = entry['facts']
-            matches = entry['matches']
+        parsed = common.forked_map(lambda source: self._parse_host(source, entries), pending, workers)
+        for source, res in zip(pending, parsed):
+            host = source[0]
+            if cache is not None and not res.get('failed'):
+                cache.set(keys[host], res['ansible_facts'])
+            results[host] = res
 
-            loop = entry.get('loop')
+        return results
 
-            section = entry.get('section')
+    def _parse_host(self, source, entries):
+        """Returns the result of parsing the output of a single host
+        """
+        host, output, output_file = source
+        self._section_index = None
+        try:
+            if output_file is not None:
+                with open(output_file, 'rb') as f:
+                    output = to_text(f.read(), errors='surrogate_or_strict')
+            return {'ansible_facts': self._parse_output(output, None, entries, 1)}
+        except (IOError, OSError) as exc:
+            return {'failed': True, 'msg': to_text(exc)}
+        finally:
+            self._section_index = None
 
-            context_data = list()
+    def _cached_parse(self, cache, plan, tags, output, output_file, entries, workers):
+        if cache is None:
+            return self._parse_output(output, output_file, entries, workers)
 
-            if section:
-                for item in self.sections:
-                    if re.match(section, item, re.I):
-                        block = self.network_config.get_block_config([item])
-                        context_data.append(block)
+        key = cache.key(self._output_digest(output, output_file), plan, tags, output_file is not None)
+        facts = cache.get(key)
+        if facts is None:
+            facts = self._parse_output(output, output_file, entries, workers)
+            cache.set(key, facts)
+        return facts
+
+    def _parse_output(self, output, output_file, entries, workers):
+        if not entries:
+            return dict()
+        if output_file is not None:
+            with open(output_file, 'rb') as f:
+                lines = (to_text(line, errors='surrogate_or_strict').rstrip('\n') for line in f)
+                return self.parse_stream(lines, entries)
+        return self.parse(output, entries, workers)
+
+    def _output_digest(self, output, output_file):
+        digest = hashlib.sha1()
+        if output_file is not None:
+            with open(output_file, 'rb') as f:
+                for chunk in iter(lambda: f.read(65536), b''):
+                    digest.update(chunk)
+        else:
+            digest.update(to_bytes(output, errors='surrogate_or_strict'))
+        return digest.hexdigest()
+
+    def parse(self, source, entries, workers=1):
+        """Parses the device output
+
+        Every entry is applied to the full output or to each of its matching
+        sections.  If more than one worker is requested, these contexts are
+        parsed by a pool of worker processes that is forked once the
+        sections are indexed.  The facts are merged in the same order as the
+        serial parse so the result is identical.
+
+        :param source: The device output
+        :param entries: The list of ParserEntry to apply
+        :param workers: The number of processes to parse with
+
+        :returns: the merged facts
+        """
+        # each context is an (entry, start, end) tuple where start and end
+        # are the offsets of the section in the index or None
+        contexts = list()
+        for entry in entries:
+            if entry.section:
+                index = self.section_index(source)
+                for start, end in index.find(entry.section):
+                    contexts.append((entry, start, end))
             else:
-                context_data.append(source)
+                contexts.append((entry, None, None))
+
+        builder = FactBuilder()
+        chunksize = max(1, len(contexts) // (workers * 4))
+        results = common.forked_map(lambda context: self._parse_context(source, context), contexts, workers, chunksize)
+        for objs in results:
+            for obj in objs:
+                builder.merge(obj)
+
+        return builder.facts
+
+    def _parse_context(self, source, context):
+        """Returns the list of fact objects for a single parse context
+        """
+        entry, start, end = context
+        if start is None:
+            data = source
+        else:
+            data = self.section_index(source).get_block(start, end)
 
-            for data in context_data:
-                variables = {'matches': list()}
+        variables = self._match(entry, data)
 
-                for match in matches:
-                    match_all = match.pop('match_all', False)
-                    pattern = match['pattern']
-                    match_var = match.get('match_var')
+        #if when is not None:
+        #    conditional = "{%% if %s %%}True{%% else %%}False{%% endif %%}"
+        #    if not self.template(conditional % when, variables):
+        #        display.vvvvv("context '%s' skipped due to conditional check failure" % name)
+        #        continue
 
-                    if match_all:
-                        res = self.re_matchall(pattern, data)
-                    else:
-                        res = self.re_search(pattern, data)
+        return list(self._template_facts(entry, variables))
 
-                    if match_var:
-                        variables[match_var] = res
-                    variables['matches'].append(res)
+    def parse_stream(self, lines, entries):
+        """Parses the device output one line at a time
 
-                #if when is not None:
-                #    conditional = "{%% if %s %%}True{%% else %%}False{%% endif %%}"
-                #    if not self.template(conditional % when, variables):
-                #        display.vvvvv("context '%s' skipped due to conditional check failure" % name)
-                #        continue
+        Only the lines of the current top level statement and the facts
+        produced so far are held in memory.  See iter_facts() for how the
+        entries are applied.
 
-                templated_obj = {}
+        :param lines: An iterable of output lines without line endings
 
-                if 'loop' in entry:
-                    loop_data = self.template(entry['loop'], variables, convert_bare=True)
-                    if loop_data:
-                        for item in to_list(loop_data):
-                            item_data = {'item': item}
-                            obj = self.template(entry['facts'], item_data)
-                            templated_facts = dict_merge(templated_facts, obj)
+        :returns: the merged facts
+        """
+        builder = FactBuilder()
+        for obj in self.iter_facts(lines, entries):
+            builder.merge(obj)
+        return builder.facts
 
-                else:
-                    obj = self.template(entry['facts'], variables)
-                    templated_facts = dict_merge(templated_facts, obj)
+    def iter_facts(self, lines, entries):
+        """Yields the facts of the device output in the order of the entries
 
-        return templated_facts
+        Entries with a ``section`` are applied to each matching section as
+        soon as the top level statement holding it is complete.  The patterns
+        of the other entries are applied to every line as it is read, so
+        patterns that span several lines only match in a section context.
+        The facts are yielded once the output is exhausted, in the order of
+        the entries in the parser file and, for each entry, of its sections,
+        the same order parse() merges them in.
+
+        :param lines: An iterable of output lines without line endings
+        :param entries: The list of ParserEntry to apply
+
+        :returns: a generator of fact objects to be merged in order
+        """
+        # the facts of each section entry, or the match results of each line
+        # entry, in the order of the entries
+        states = list()
+        section_entries = list()
+        line_entries = list()
+
+        for entry in entries:
+            if entry.section:
+                facts = list()
+                section_entries.append((entry, facts))
+                states.append((entry, facts))
+            else:
+                results = [list() if m.match_all else None for m in entry.matches]
+                line_entries.append((entry, results))
+                states.append((entry, results))
+
+        def feed(lines):
+            for line in lines:
+                for entry, results in line_entries:
+                    for index, match in enumerate(entry.matches):
+                        if match.literal and match.literal not in line:
+                            continue
+                        elif match.match_all:
+                            results[index].extend(self.re_matchall(match.regex, line))
+                        elif results[index] is None:
+                            results[index] = self.re_search(match.regex, line)
+                yield line
+
+        if section_entries:
+            for statement, sections in iter_sections(feed(lines)):
+                for entry, facts in section_entries:
+                    for header, start, end in sections:
+                        if entry.section.match(header):
+                            variables = self._match(entry, format_block(statement[start:end]))
+                            facts.extend(self._template_facts(entry, variables))
+
+        else:
+            # without sections the output is only read until every pattern
+            # has matched, unless a pattern has to match all lines
+            complete = not any(m.match_all for entry, results in line_entries for m in entry.matches)
+            for line in feed(lines):
+                if complete and all(r is not None for entry, results in line_entries for r in results):
+                    break
+
+        for entry, state in states:
+            if entry.section:
+                for obj in state:
+                    yield obj
+                continue
+
+            variables = {'matches': state}
+            for match, res in zip(entry.matches, state):
+                if match.match_var:
+                    variables[match.match_var] = res
+            for obj in self._template_facts(entry, variables):
+                yield obj
+
+    def _match(self, entry, data):
+        """Applies the entry patterns to data and returns the variables
+        """
+        variables = {'matches': list()}
+
+        found = entry.scanner.scan(data) if entry.scanner else None
+
+        for match in entry.matches:
+            if found is not None and match.literal and match.literal not in found:
+                res = list() if match.match_all else None
+            elif match.match_all:
+                res = self.re_matchall(match.regex, data)
+            else:
+                res = self.re_search(match.regex, data)
+
+            if match.match_var:
+                variables[match.match_var] = res
+            variables['matches'].append(res)
+
+        return variables
+
+    def _template_facts(self, entry, variables):
+        """Yields the facts of the entry filled in for the matched variables
+        """
+        if entry.loop is not None:
+            loop_data = self.template(entry.loop, variables, convert_bare=True)
+            if loop_data:
+                for item in to_list(loop_data):
+                    item_data = {'item': item}
+                    yield self.fill_facts(entry.facts, item_data)
+
+        else:
+            yield self.fill_facts(entry.facts, variables)
+
+    def _load_parser(self, path):
+        """ Returns the compiled parser for the parser file
+
+        The parser is compiled at most once per run and process, see
+        load_compiled() in network_config/common.py.
+
+        :param path: The absolute path to the parser file
+
+        :returns: an instance of ParserPlan
+        """
+        return common.load_compiled(path, _PARSER_CACHE, _SHARED_PLANS, self._compile_parser)
+
+    def _compile_parser(self, path, mtime, digest):
+        display.vvvv('compiling parser for %s' % path)
+        contents = self._loader.load_from_file(path, cache=False)
+        entries = compile_parser(contents, self._templar.environment)
+        return ParserPlan(path, mtime, digest, entries, index_tags(entries))
+
+    def section_index(self, source):
+        """Returns the section index of the source, building it on first use
+        """
+        if self._section_index is None:
+            self._section_index = SectionIndex(source)
+        return self._section_index
 
     def template(self, data, variables, convert_bare=False):
 
-        if isinstance(data, collections.Mapping):
+        if isinstance(data, Mapping):
             templated_data = {}
             for key, value in iteritems(data):
                 templated_key = self.template(key, variables, convert_bare=convert_bare)
                 templated_data[templated_key] = self.template(value, variables, convert_bare=convert_bare)
             return templated_data
 
-        elif isinstance(data, collections.Iterable) and not isinstance(data, string_types):
+        elif isinstance(data, Iterable) and not isinstance(data, string_types):
             return [self.template(i, variables, convert_bare=convert_bare) for i in data]
 
         else:
@@ -154,21 +1017,71 @@ class ActionModule(ActionBase):
                 self._templar.set_available_variables(tmp_avail_vars)
             return resp
 
+    def fill_facts(self, node, variables):
+        """Returns the facts of a compiled skeleton filled in with variables
+
+        :param node: The root node of the skeleton from compile_facts()
+        :param variables: The dict of variables available to the templates
+
+        :returns: the facts object
+        """
+        # the templar templates variable values again when they are accessed
+        # so references are only resolved directly if no value is a template
+        plain = not self._contains_template(variables)
+
+        tmp_avail_vars = self._templar._available_variables
+        self._templar.set_available_variables(variables)
+        try:
+            return self._fill(node, variables, plain)
+        finally:
+            self._templar.set_available_variables(tmp_avail_vars)
+
+    def _fill(self, node, variables, plain):
+        if isinstance(node, StaticFact):
+            return node.value
+
+        elif isinstance(node, DictFact):
+            obj = dict()
+            for key, value in node.items:
+                obj[self._fill(key, variables, plain)] = self._fill(value, variables, plain)
+            return obj
+
+        elif isinstance(node, ListFact):
+            return [self._fill(i, variables, plain) for i in node.items]
+
+        if plain and node.reference:
+            value = common.resolve_reference(node.reference, variables, self._templar.environment)
+            if isinstance(value, Undefined):
+                return node.convert(None)
+            elif isinstance(value, string_types):
+                # leave the values the templar would literal_eval to it
+                if not value.startswith(('{', '[')) and value not in ('True', 'False'):
+                    return node.convert(value)
+            elif isinstance(value, integer_types) and not isinstance(value, bool):
+                return node.convert(value)
+
+        try:
+            value = self._templar.template(node.value)
+        except AnsibleUndefinedVariable:
+            return node.convert(None)
+        return node.convert(value)
+
+    def _contains_template(self, data):
+        if isinstance(data, string_types):
+            return common.is_template(data, self._templar.environment)
+        elif isinstance(data, Mapping):
+            return any(self._contains_template(v) for v in data.values())
+        elif isinstance(data, (list, tuple)):
+            return any(self._contains_template(v) for v in data)
+        return False
+
     def _coerce_to_native(self, value):
-        if not isinstance(value, bool):
-            try:
-                value = int(value)
-            except:
-                if len(value) == 0:
-                    return None
-                pass
-        return value
+        return coerce_to_native(value)
 
-    def re_search(self, pattern, value):
-        match = re.search(pattern, value, re.M)
+    def re_search(self, regex, value):
+        match = regex.search(value)
         if match:
             return list(match.groups())
 
-    def re_matchall(self, pattern, value):
-        return re.findall(pattern, value)
-
+    def re_matchall(self, regex, value):
+        return regex.findall(value)
@@ -11,14 +11,49 @@ __metaclass__ = type
 
 import os
 import re
+import sys
+import fcntl
+import json
+import pickle
+import fnmatch
+import hashlib
+import tempfile
+import math
+import time
+import contextlib
 import collections
 
+import jinja2.meta
+
 from ansible import constants as C
-from ansible.plugins.action.normal import ActionModule as ActionBase
+from ansible.plugins.action import ActionBase
 from ansible.module_utils.network.common.utils import to_list
-from ansible.module_utils.six import iteritems, string_types
-from ansible.module_utils._text import to_text
+from ansible.module_utils.six import iteritems, integer_types, string_types
+from ansible.module_utils._text import to_bytes, to_text
+from ansible.module_utils.parsing.convert_bool import boolean
 from ansible.errors import AnsibleError, AnsibleUndefinedVariable
+from ansible.utils.unsafe_proxy import wrap_var
+from ansible.template.vars import AnsibleJ2Vars
+
+# the compat module is only shipped with ansible 2.8 and later
+try:
+    from ansible.module_utils.common._collections_compat import Iterable, Mapping
+except ImportError:
+    try:
+        from collections.abc import Iterable, Mapping
+    except ImportError:
+        from collections import Iterable, Mapping
+
+try:
+    from os import scandir
+except ImportError:
+    scandir = None
+
+try:
+    from importlib.util import spec_from_file_location, module_from_spec
+except ImportError:
+    import imp
+    spec_from_file_location = None
 
 try:
     from __main__ import display
@@ -29,14 +64,719 @@ except ImportError:
 
 MISSING_KEY_OPTIONS = frozenset(('warn', 'fail', 'ignore'))
 
+CONDITIONAL = "{%% if %s %%}True{%% else %%}False{%% endif %%}"
+
+
+# compiled template plans are cached for the lifetime of the process and
+# are keyed by the template path.  the cached plan is reused as long as the
+# file mtime or, failing that, the content hash is unchanged
+_PLAN_CACHE = dict()
+
+TemplatePlan = collections.namedtuple('TemplatePlan', ['path', 'mtime', 'digest', 'nodes'])
+
+# lines that only substitute variables or attributes are compiled into
+# ``parts``, a tuple of literal strings and (name, path) references that can
+# be formatted without the templar.  ``parts`` is None for all other lines
+Line = collections.namedtuple('Line', ['value', 'is_template', 'parts'])
+
+# every node records the set of variables it reads in ``depends``.  the
+# value is None when the variables cannot be determined statically.  the
+# ``pos`` value is the tuple of the template path and the line number of the
+# entry
+LinesNode = collections.namedtuple('LinesNode', [
+    'name', 'lines', 'when', 'loop', 'loop_var', 'required', 'join',
+    'join_delimiter', 'indent', 'missing_key', 'depends', 'pos'
+])
+
+BlockNode = collections.namedtuple('BlockNode', ['name', 'block', 'when', 'loop', 'loop_var', 'depends', 'pos'])
+
+IncludeNode = collections.namedtuple('IncludeNode', ['name', 'include', 'when', 'loop', 'loop_var', 'depends', 'pos'])
+
+# variables that give templates access to values that cannot be tracked
+# statically.  any expression that references one of these is never cached
+DYNAMIC_VARIABLES = frozenset(('vars', 'hostvars', 'lookup', 'query', 'q', 'now'))
+
+RENDER_CACHE_VERSION = 2
+
+# variables that differ for every host.  entries that read one of these, or
+# any ``ansible_`` variable such as the facts and connection settings, are
+# never shared across hosts
+HOST_VARIABLES = frozenset(('inventory_hostname', 'inventory_hostname_short', 'inventory_dir',
+                            'inventory_file', 'group_names', 'playbook_dir'))
+
+# value types that are rendered by the line formatter
+FORMAT_TYPES = string_types + integer_types + (float,)
+
+# compiled include_files / exclude_files matchers keyed by the patterns
+_MATCHER_CACHE = dict()
+
+# regular files found in each source directory keyed by path.  the listing
+# is reused as long as the directory mtime is unchanged
+_SCAN_CACHE = dict()
+
+# conditionals compiled by the jinja2 environment of the templar and loop
+# references, both keyed by the directive value.  plans are shared across
+# processes so the compiled jinja2 objects are kept per process instead
+_CONDITIONAL_CACHE = dict()
+
+_LOOP_CACHE = dict()
+
+BACKREFERENCE_RE = re.compile(r'\\\d|\(\?P=')
+
+# inline flags such as (?i) apply to the whole expression, or are rejected
+# when they are not at its start, so patterns using them are never combined
+INLINE_FLAGS_RE = re.compile(r'\(\?[aiLmsux]+\)')
+
 
 def warning(msg):
     if C.ACTION_WARNINGS:
         display.warning(msg)
 
 
+def load_module(name):
+    """ Loads a module of the network_config directory next to the plugins
+
+    The role is not on the python path of the controller, so the code shared
+    by the action plugins is loaded from its file, once per process.
+    """
+    full_name = 'network_config_%s' % name
+    module = sys.modules.get(full_name)
+    if module is not None:
+        return module
+
+    path = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'network_config', '%s.py' % name)
+    if spec_from_file_location is None:
+        return imp.load_source(full_name, path)
+
+    spec = spec_from_file_location(full_name, path)
+    module = module_from_spec(spec)
+    sys.modules[full_name] = module
+    try:
+        spec.loader.exec_module(module)
+    except Exception:
+        del sys.modules[full_name]
+        raise
+    return module
+
+
+common = load_module('common')
+
+
+class VariableScope(dict):
+    """ Layered view of the template variables
+
+    The scope holds only the variables assigned at this layer, such as the
+    current loop variable, and resolves everything else from the parent
+    mapping.  This allows loops to push a new scope for every iteration
+    without copying the (potentially very large) set of host variables.
+
+    This is a subclass of dict as the templar requires the available
+    variables to be one.
+    """
+
+    def __init__(self, variables=None, parent=None):
+        super(VariableScope, self).__init__(variables or {})
+        self._parent = parent if parent is not None else {}
+
+    def __getitem__(self, key):
+        try:
+            return dict.__getitem__(self, key)
+        except KeyError:
+            return self._parent[key]
+
+    def __contains__(self, key):
+        return dict.__contains__(self, key) or key in self._parent
+
+    def __iter__(self):
+        for key in dict.__iter__(self):
+            yield key
+        for key in self._parent:
+            if not dict.__contains__(self, key):
+                yield key
+
+    def __len__(self):
+        return len(self.keys())
+
+    def __bool__(self):
+        return dict.__len__(self) > 0 or bool(self._parent)
+
+    __nonzero__ = __bool__
+
+    def __repr__(self):
+        return '%s(%s, parent=%r)' % (type(self).__name__, dict.__repr__(self), self._parent)
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def keys(self):
+        return list(self)
+
+    def values(self):
+        return [self[key] for key in self]
+
+    def items(self):
+        return [(key, self[key]) for key in self]
+
+    def copy(self):
+        return dict(self.items())
+
+
+def compile_matcher(matches):
+    """ Compiles a list of file patterns into a single matcher
+
+    Patterns are regular expressions that are searched for in the filename
+    unless prefixed with ``glob:``, in which case the pattern is a shell
+    style wildcard that must match the whole filename.  The patterns are
+    combined into a single alternation so each filename is scanned once,
+    unless one of them uses backreferences or inline flags.
+
+    :param matches: The pattern or list of patterns
+
+    :returns: callable that returns True if a filename matches any pattern
+    """
+    if isinstance(matches, string_types):
+        matches = [matches]
+    if not isinstance(matches, list):
+        raise AnsibleError("matches must be a valid list")
+
+    key = tuple(to_text(item) for item in matches)
+    matcher = _MATCHER_CACHE.get(key)
+    if matcher is not None:
+        return matcher
+
+    patterns = list()
+    for pattern in key:
+        if pattern.startswith('glob:'):
+            pattern = r'\A' + fnmatch.translate(pattern[5:])
+        patterns.append(pattern)
+
+    try:
+        if any(BACKREFERENCE_RE.search(item) or INLINE_FLAGS_RE.search(item) for item in patterns):
+            raise re.error('patterns with backreferences or inline flags cannot be combined')
+        regexes = [re.compile('|'.join('(?:%s)' % item for item in patterns))]
+    except re.error:
+        regexes = [re.compile(item) for item in patterns]
+
+    def matcher(filename):
+        for regex in regexes:
+            if regex.search(filename):
+                return True
+        return False
+
+    _MATCHER_CACHE[key] = matcher
+    return matcher
+
+
+def scan_directory(path):
+    """ Returns the sorted list of regular files in the directory
+
+    The listing is kept for the life of the process and shared with the
+    worker processes of the other hosts of the run through _SHARED_SCANS,
+    keyed by the directory mtime, so the directory is scanned once per run.
+    """
+    mtime = os.stat(path).st_mtime
+    cached = _SCAN_CACHE.get(path)
+    if cached is not None and cached[0] == mtime:
+        return cached[1]
+
+    filenames = _SHARED_SCANS.get(path, repr(mtime))
+    if filenames is None:
+        if scandir is not None:
+            filenames = [entry.name for entry in scandir(path) if entry.is_file()]
+        else:
+            filenames = [name for name in os.listdir(path) if os.path.isfile(os.path.join(path, name))]
+        filenames = tuple(sorted(filenames))
+        _SHARED_SCANS.set(path, repr(mtime), filenames)
+
+    _SCAN_CACHE[path] = (mtime, filenames)
+    return filenames
+
+
+def find_variables(value, environment, convert_bare=False):
+    """ Returns the set of variable names referenced by a template string
+
+    :param value: The template string to inspect
+    :param environment: The jinja2 environment used to parse the string
+    :param convert_bare: Treat a string without template markers as a bare
+        variable reference the same way the templar does
+
+    :returns: frozenset of variable names or None if the variables cannot
+        be determined statically
+    """
+    if value is None:
+        return frozenset()
+    elif not isinstance(value, string_types):
+        return None
+
+    if not common.is_template(value, environment):
+        if not convert_bare:
+            return frozenset()
+        value = '%s%s%s' % (environment.variable_start_string, value, environment.variable_end_string)
+
+    try:
+        names = jinja2.meta.find_undeclared_variables(environment.parse(value))
+    except jinja2.TemplateSyntaxError:
+        return None
+
+    if DYNAMIC_VARIABLES.intersection(names):
+        return None
+    return frozenset(names)
+
+
+def compile_line(value, environment):
+    """ Compiles a line that only performs variable substitution
+
+    Lines that consist solely of literal text and references to variables
+    or their attributes are compiled into a tuple of parts that can be
+    formatted directly, see common.compile_line().  All other lines return
+    None and are always rendered by the templar.
+
+    :param value: The line to compile
+    :param environment: The jinja2 environment used to parse the line
+
+    :returns: tuple of parts or None
+    """
+    return common.compile_line(value, environment, DYNAMIC_VARIABLES)
+
+
+def compile_conditional(value, templar):
+    """ Compiles a conditional into a jinja2 template
+
+    The template is compiled using the same environment, filters and tests
+    the templar uses, so rendering it gives the same result as templating
+    the conditional.  Conditionals that use lookups or the vars and hostvars
+    variables, or that contain backslashes, return None and are always
+    evaluated by the templar.
+
+    :param value: The wrapped conditional, see CONDITIONAL
+    :param templar: The templar of the task
+
+    :returns: jinja2 template or None
+    """
+    if '\\' in value or find_variables(value, templar.environment) is None:
+        return None
+
+    environment = templar.environment.overlay()
+    environment.filters.update(templar._get_filters())
+    environment.tests.update(templar._get_tests())
+
+    try:
+        template = environment.from_string(value)
+    except jinja2.TemplateSyntaxError:
+        return None
+    template.globals['dict'] = dict
+    return template
+
+
+def compile_loop(value, environment):
+    """ Compiles a loop that only references a variable or its attributes
+
+    The value is compiled the same way the templar converts a bare loop
+    value.  A bare value is only converted by the templar if the variable
+    it starts with is defined, which is checked when the loop is rendered.
+
+    :param value: The loop directive value
+    :param environment: The jinja2 environment used to parse the value
+
+    :returns: (name, path) reference or None
+    """
+    if not isinstance(value, string_types):
+        return None
+
+    first_part = None
+    if environment.variable_start_string not in value:
+        first_part = value.split('|')[0].split('.')[0].split('[')[0]
+        value = '%s%s%s' % (environment.variable_start_string, value, environment.variable_end_string)
+
+    parts = compile_line(value, environment)
+    if not parts or len(parts) != 1 or isinstance(parts[0], string_types):
+        return None
+
+    reference = parts[0]
+    if first_part is not None and first_part != reference[0]:
+        return None
+    return reference
+
+
+def is_literal(value):
+    """ Checks if the value is unchanged when converted to text and back
+
+    The templar renders loop values to text and converts the text back
+    with safe_eval, which only returns an equal value for plain lists,
+    dicts, strings, numbers, booleans and None.  Unsafe values are wrapped
+    again by the templar and never match.
+    """
+    if hasattr(value, '__UNSAFE__'):
+        return False
+    elif value is None or isinstance(value, string_types + integer_types):
+        return True
+    elif isinstance(value, float):
+        return not math.isinf(value) and not math.isnan(value)
+    elif isinstance(value, list):
+        return all(is_literal(item) for item in value)
+    elif isinstance(value, dict):
+        return all(is_literal(key) and is_literal(item) for key, item in iteritems(value))
+    return False
+
+
+def _union(*args):
+    if any(item is None for item in args):
+        return None
+    return frozenset().union(*args)
+
+
+def compile_template(contents, environment):
+    """ Compiles the template contents into an immutable plan
+
+    The template entries are walked once and converted into a tuple of
+    ``BlockNode``, ``LinesNode`` and ``IncludeNode`` objects.  Conditional
+    statements are wrapped, each line is checked for template markers so
+    that static text never needs to be passed to the templar and the
+    variables read by each node are recorded.
+
+    :param contents: The list of entries loaded from the template file
+    :param environment: The jinja2 environment used by the templar
+
+    :returns: tuple of compiled template nodes
+    """
+    if not contents:
+        return tuple()
+    if not isinstance(contents, list):
+        raise AnsibleError('template contents must be a valid list')
+    return tuple(_compile_entry(entry, environment) for entry in contents)
+
+
+def _compile_entry(entry, environment):
+    if not isinstance(entry, Mapping):
+        raise AnsibleError('template entry must be a dict, got %s' % type(entry).__name__)
+
+    name = entry.get('name')
+
+    pos = getattr(entry, 'ansible_pos', None)
+    if pos:
+        pos = (pos[0], pos[1])
+
+    when = entry.get('when')
+    when_depends = frozenset()
+    if when is not None:
+        when = CONDITIONAL % when
+        when_depends = find_variables(when, environment)
+
+    loop = entry.get('loop')
+    loop_depends = find_variables(loop, environment, convert_bare=True)
+
+    loop_control = entry.get('loop_control') or {'loop_var': 'item'}
+    loop_var = loop_control['loop_var']
+
+    if entry.get('include'):
+        return IncludeNode(name, entry['include'], when, loop, loop_var, None, pos)
+
+    elif 'block' in entry:
+        block = tuple(_compile_entry(item, environment) for item in entry['block'] or [])
+        depends = _union(when_depends, *[item.depends for item in block])
+        if loop and depends is not None:
+            depends = depends.difference([loop_var])
+        return BlockNode(name, block, when, loop, loop_var, _union(depends, loop_depends), pos)
+
+    elif 'lines' not in entry:
+        raise AnsibleError("missing required block entry `lines`")
+
+    missing_key = entry.get('missing_key') or 'warn'
+    if missing_key not in MISSING_KEY_OPTIONS:
+        raise AnsibleError('option missing_key expected one of %s, got %s' % (', '.join(MISSING_KEY_OPTIONS), missing_key))
+
+    lines = list()
+    lines_depends = list()
+    for item in to_list(entry['lines']):
+        if isinstance(item, string_types):
+            templated = common.is_template(item, environment)
+            lines.append(Line(item, templated, compile_line(item, environment) if templated else None))
+        else:
+            lines.append(Line(item, True, None))
+        lines_depends.append(find_variables(item, environment))
+
+    depends = _union(*lines_depends)
+    if loop and depends is not None:
+        depends = depends.difference([loop_var])
+
+    return LinesNode(name, tuple(lines), when, loop, loop_var,
+                     entry.get('required'), entry.get('join'),
+                     entry.get('join_delimiter') or ' ', entry.get('indent'),
+                     missing_key, _union(depends, when_depends, loop_depends), pos)
+
+
+def _iter_includes(nodes):
+    """ Yields the include nodes that are rendered whatever the variables
+
+    Includes under a ``when`` or a ``loop``, their own or the one of an
+    enclosing block, might never be rendered and are skipped.
+    """
+    for node in nodes:
+        if node.when or node.loop:
+            continue
+        if isinstance(node, IncludeNode):
+            yield node
+        elif isinstance(node, BlockNode):
+            for include in _iter_includes(node.block):
+                yield include
+
+
+class RenderProfile(object):
+    """ Collects render statistics for the template entries
+
+    Statistics are keyed by the file and line number of the entry, where the
+    file is relative to ``root`` so templates with the same name in
+    different directories are kept apart, and are inclusive, the time and
+    templar calls of a block include those of the entries nested in it.
+    """
+
+    FIELDS = ('count', 'time', 'templar_calls', 'iterations', 'skipped', 'lines')
+
+    def __init__(self, root=None):
+        self.root = root
+        self.stats = dict()
+        self.templar_calls = 0
+        self._stack = list()
+
+    def _entry(self, node):
+        if node.pos:
+            path, line = node.pos
+            if self.root:
+                path = os.path.relpath(path, self.root)
+            key = '%s:%s' % (path, line)
+        else:
+            key = node.name or type(node).__name__
+        entry = self.stats.get(key)
+        if entry is None:
+            entry = dict.fromkeys(self.FIELDS, 0)
+            entry['name'] = node.name
+            self.stats[key] = entry
+        return entry
+
+    def measure(self, node, func, *args):
+        entry = self._entry(node)
+        self._stack.append(entry)
+
+        templar_calls = self.templar_calls
+        start = time.time()
+        try:
+            values = func(node, *args)
+        finally:
+            entry['time'] += time.time() - start
+            entry['templar_calls'] += self.templar_calls - templar_calls
+            entry['count'] += 1
+            self._stack.pop()
+
+        entry['lines'] += len(values or ())
+        return values
+
+    def record(self, iterations=0, skipped=0):
+        if self._stack:
+            entry = self._stack[-1]
+            entry['iterations'] += iterations
+            entry['skipped'] += skipped
+
+    def merge(self, report):
+        self.templar_calls += report['templar_calls']
+        for key, stats in iteritems(report['blocks']):
+            entry = self.stats.setdefault(key, dict.fromkeys(self.FIELDS, 0))
+            entry['name'] = stats.get('name')
+            for field in self.FIELDS:
+                entry[field] += stats.get(field, 0)
+
+    def report(self):
+        return {'templar_calls': self.templar_calls, 'blocks': self.stats}
+
+
+class RenderCache(object):
+    """ Per host cache of the rendered top level template entries
+
+    Each rendered entry is stored along with a fingerprint of the values of
+    the variables it depends on.  An entry is reused on the next run as long
+    as the template file and the fingerprint are unchanged.  The fingerprints
+    of each template file are kept in an index file in the host cache
+    directory and the lines of each entry in a file of their own, which is
+    only read when the entry is written out, so the cached output is never
+    held in memory as a whole.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.reused = list()
+        self._indexes = dict()
+        self._changed = set()
+        self._obsolete = list()
+
+    def _filename(self, plan):
+        key = hashlib.sha1(to_bytes(plan.path, errors='surrogate_or_strict')).hexdigest()
+        return os.path.join(self.path, key)
+
+    def _entry_filename(self, plan, index, fingerprint):
+        return '%s.%s.%s' % (self._filename(plan), index, fingerprint)
+
+    def _load(self, plan):
+        entries = self._indexes.get(plan.path)
+        if entries is not None:
+            return entries
+
+        entries = dict()
+        try:
+            with open(self._filename(plan), 'rb') as f:
+                data = pickle.load(f)
+            if data.get('version') == RENDER_CACHE_VERSION:
+                if data.get('digest') == plan.digest:
+                    entries = data['entries']
+                else:
+                    # the template changed, none of its entries are valid
+                    self._obsolete.extend(self._entry_filename(plan, index, fingerprint)
+                                          for index, fingerprint in iteritems(data['entries']))
+                    self._changed.add(plan)
+        except (IOError, OSError, EOFError, ValueError, TypeError, AttributeError, KeyError, pickle.UnpicklingError):
+            pass
+
+        self._indexes[plan.path] = entries
+        return entries
+
+    def get(self, plan, index, fingerprint):
+        """ Returns True if the entry is cached with the same fingerprint
+
+        The lines of the entry are read with ``lines()``.
+        """
+        if fingerprint is None or self._load(plan).get(index) != fingerprint:
+            return False
+        if not os.path.isfile(self._entry_filename(plan, index, fingerprint)):
+            return False
+        node = plan.nodes[index]
+        self.reused.append('%s:%s' % (os.path.basename(plan.path), node.name or index))
+        return True
+
+    def lines(self, plan, index, fingerprint):
+        """ Returns the cached lines of the entry or None if they can not be read
+        """
+        try:
+            with open(self._entry_filename(plan, index, fingerprint), 'rb') as f:
+                return pickle.load(f)
+        except (IOError, OSError, EOFError, ValueError, TypeError, AttributeError, pickle.UnpicklingError):
+            return None
+
+    def set(self, plan, index, fingerprint, lines):
+        """ Writes the lines of the entry to its file
+
+        The index of the template file is only written by ``save()``.
+        """
+        entries = self._load(plan)
+        previous = entries.pop(index, None)
+        if previous is not None:
+            self._changed.add(plan)
+            if previous != fingerprint:
+                self._obsolete.append(self._entry_filename(plan, index, previous))
+        if fingerprint is None:
+            return
+
+        if not os.path.isdir(self.path):
+            os.makedirs(self.path)
+        fd, tmp_path = tempfile.mkstemp(dir=self.path, prefix='.render.')
+        with os.fdopen(fd, 'wb') as f:
+            pickle.dump(list(lines), f, 2)
+        os.rename(tmp_path, self._entry_filename(plan, index, fingerprint))
+
+        entries[index] = fingerprint
+        self._changed.add(plan)
+
+    def save(self):
+        """ Writes the index of the changed template files
+
+        The files of the replaced entries are removed once the index no
+        longer refers to them.
+        """
+        if self._changed and not os.path.isdir(self.path):
+            os.makedirs(self.path)
+        for plan in self._changed:
+            data = {'version': RENDER_CACHE_VERSION, 'digest': plan.digest,
+                    'entries': self._indexes[plan.path]}
+            fd, tmp_path = tempfile.mkstemp(dir=self.path, prefix='.render.')
+            with os.fdopen(fd, 'wb') as f:
+                pickle.dump(data, f, 2)
+            os.rename(tmp_path, self._filename(plan))
+        self._changed.clear()
+
+        for path in self._obsolete:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+        del self._obsolete[:]
+
+
+def is_host_independent(depends):
+    """ Returns True if the variables read by an entry are not host specific
+    """
+    if depends is None:
+        return False
+    return not any(name in HOST_VARIABLES or name.startswith('ansible_') for name in depends)
+
+
+class SharedRenderCache(object):
+    """ Rendered top level entries shared by all the hosts of a run
+
+    Entries that only read variables which are not host specific, such as
+    group vars and ``private_vars``, are stored under a hash of the template
+    content, the entry index and the fingerprint of the variable values, so
+    every host with the same values reuses the output of the first host
+    that rendered it.  The store is kept in the local temporary directory of
+    the run, which is readable by all the forks.  Each entry is rendered
+    while holding a lock on its key so that concurrent forks wait for it
+    instead of rendering it as well.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.reused = list()
+        if not os.path.isdir(path):
+            try:
+                os.makedirs(path)
+            except OSError:
+                if not os.path.isdir(path):
+                    raise
+
+    def key(self, plan, index, fingerprint):
+        data = json.dumps([RENDER_CACHE_VERSION, plan.digest, index, fingerprint])
+        return hashlib.sha1(to_bytes(data, errors='surrogate_or_strict')).hexdigest()
+
+    @contextlib.contextmanager
+    def lock(self, key):
+        with open(os.path.join(self.path, '%s.lock' % key), 'a') as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            yield
+
+    def get(self, key):
+        try:
+            with open(os.path.join(self.path, key), 'rb') as f:
+                return pickle.load(f)
+        except (IOError, OSError, EOFError, ValueError, TypeError, AttributeError, pickle.UnpicklingError):
+            return None
+
+    def set(self, key, lines):
+        fd, tmp_path = tempfile.mkstemp(dir=self.path, prefix='.render.')
+        with os.fdopen(fd, 'wb') as f:
+            pickle.dump(list(lines), f, 2)
+        os.rename(tmp_path, os.path.join(self.path, key))
+
+
+_SHARED_PLANS = common.SharedCache('config_template')
+
+_SHARED_SCANS = common.SharedCache('config_template-scan')
+
+
 class ActionModule(ActionBase):
 
+    _render_cache = None
+    _shared_cache = None
+    _profile = None
+
     def set_args(self):
         """ sets instance variables based on passed arguments
         """
@@ -49,6 +789,23 @@ class ActionModule(ActionBase):
 
         self.private_vars = self._task.args.get('private_vars') or {}
 
+        self.dest = self._task.args.get('dest')
+
+        self._include_paths = dict()
+        self._include_stack = list()
+        self._checked_includes = set()
+
+        self.cache_dir = self._task.args.get('cache_dir')
+        self.shared_cache = boolean(self._task.args.get('shared_cache', False), strict=False)
+
+        self.profile = boolean(self._task.args.get('profile', False), strict=False)
+        self.profile_dest = self._task.args.get('profile_dest')
+
+        try:
+            self.workers = int(self._task.args.get('workers') or 1)
+        except (TypeError, ValueError):
+            raise AnsibleError('workers must be an integer value')
+
     def run(self, tmp=None, task_vars=None):
         if task_vars is None:
             task_vars = dict()
@@ -57,25 +814,311 @@ class ActionModule(ActionBase):
 
         self.set_args()
 
-        variables = task_vars.copy()
-        variables.update(self.private_vars)
+        variables = VariableScope(self.private_vars, task_vars)
+
+        self._profile = RenderProfile(self.source_dir) if self.profile else None
+
+        self._render_cache = None
+        if self.cache_dir:
+            host = task_vars.get('inventory_hostname') or 'localhost'
+            self._render_cache = RenderCache(os.path.join(os.path.expanduser(self.cache_dir), host))
+
+        self._shared_cache = None
+        if self.shared_cache:
+            if C.DEFAULT_LOCAL_TMP and os.path.isdir(C.DEFAULT_LOCAL_TMP):
+                self._shared_cache = SharedRenderCache(os.path.join(C.DEFAULT_LOCAL_TMP, 'config_template-render'))
+            else:
+                warning('the local temporary directory is not available, entries are not shared')
 
-        lines = list()
         include_files = self.included_files()
+        lines = self.render(include_files, variables)
 
+        try:
+            if self.dest:
+                result = self._write_dest(lines, self.dest)
+            else:
+                lines = list(lines)
+                result = {'lines': lines, 'text': '\n'.join(lines)}
+        except AnsibleError as exc:
+            return {'failed': True, 'msg': to_text(exc)}
+
+        result['included_files'] = include_files
+        if self._render_cache is not None:
+            result['reused_blocks'] = self._render_cache.reused
+        if self._shared_cache is not None:
+            result['shared_blocks'] = self._shared_cache.reused
+
+        if self._profile is not None:
+            result['profile'] = self._profile.report()
+            if self.profile_dest:
+                host = task_vars.get('inventory_hostname') or 'localhost'
+                self._write_profile(self.profile_dest, host, result['profile'])
+
+        return result
+
+    def _write_profile(self, path, host, report):
+        """ Merges the host profile into the aggregated profile report
+
+        The report file is locked while it is updated so that every fork can
+        add its host profile to the same file.  The report is identified by
+        the local temporary directory of the run, which is unique to each
+        run, so a report left by a previous run is replaced instead of
+        being added to.
+        """
+        path = os.path.expanduser(path)
+        run = C.DEFAULT_LOCAL_TMP
+        with open(path, 'a+') as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            f.seek(0)
+            data = f.read()
+
+            profile = RenderProfile()
+            hosts = dict()
+            if data.strip():
+                aggregated = json.loads(data)
+                if aggregated.get('run') == run:
+                    profile.merge(aggregated)
+                    hosts = aggregated.get('hosts', {})
+
+            profile.merge(report)
+            hosts[host] = hosts.get(host, 0) + 1
+
+            aggregated = profile.report()
+            aggregated['hosts'] = hosts
+            aggregated['run'] = run
+
+            f.seek(0)
+            f.truncate()
+            json.dump(aggregated, f, indent=2, sort_keys=True)
+
+    def render(self, include_files, variables):
+        """ Renders the list of template files
+
+        The files are rendered in the order provided and the output is
+        generated one top level template entry at a time so the caller can
+        stream the configuration without holding all of it in memory.  When
+        the render cache is enabled, entries whose dependent variables are
+        unchanged since the last run are taken from the cache.  When the
+        shared cache is enabled, entries that do not read host specific
+        variables are rendered once for all the hosts of the run with the
+        same values.
+
+        :param include_files: The ordered list of template files to render
+        :param variables: The variables used to render the templates
+
+        :returns: generator of rendered configuration lines
+        """
+        units = list()
         for source in include_files:
-            display.display('including file %s' % source)
-            contents = self._loader.load_from_file(source)
+            plan = self._load_plan(source)
+            self._check_includes(plan)
+            units.extend((plan, index) for index in range(len(plan.nodes)))
+
+        # each unit is taken from the render cache, from the shared cache or
+        # rendered by _render_nodes() in the order of units
+        fingerprints = list()
+        sources = list()
+        pending = list()
+
+        for plan, index in units:
+            node = plan.nodes[index]
+            shared = self._shared_cache is not None and is_host_independent(node.depends)
+
+            fingerprint = source = None
+            if self._render_cache is not None or shared:
+                fingerprint = self._fingerprint(node.depends, variables)
+            if self._render_cache is not None and self._render_cache.get(plan, index, fingerprint):
+                source = 'cache'
+            elif shared and fingerprint is not None:
+                source = 'shared'
+            else:
+                pending.append(node)
+            fingerprints.append(fingerprint)
+            sources.append(source)
 
-            try:
-                lines = self._process_template(contents, variables)
-            except AnsibleError as exc:
-                return {'failed': True, 'msg': to_text(exc)}
+        results = self._render_nodes(pending, variables)
+
+        try:
+            current = None
+            for (plan, index), fingerprint, source in zip(units, fingerprints, sources):
+                if plan.path != current:
+                    display.display('including file %s' % plan.path)
+                    current = plan.path
+
+                # cached entries are read from disk one at a time, only the
+                # lines of the current entry are held in memory
+                lines = None
+                if source == 'cache':
+                    lines = self._render_cache.lines(plan, index, fingerprint)
+
+                if lines is None:
+                    if source == 'cache':
+                        # the entry file could not be read after all
+                        lines = self._process_template([plan.nodes[index]], variables)
+                    elif source == 'shared':
+                        lines = self._render_shared(plan, index, fingerprint, variables)
+                    else:
+                        lines = next(results)
+                    if self._render_cache is not None:
+                        self._render_cache.set(plan, index, fingerprint, lines)
+                for line in lines:
+                    yield line
+        finally:
+            results.close()
+
+        if self._render_cache is not None:
+            self._render_cache.save()
+
+    def _render_shared(self, plan, index, fingerprint, variables):
+        """ Returns the lines of a host independent entry
+
+        The entry is taken from the shared cache or rendered and added to it
+        if no other host has rendered it with the same variable values yet.
+        """
+        node = plan.nodes[index]
+        key = self._shared_cache.key(plan, index, fingerprint)
+
+        with self._shared_cache.lock(key):
+            lines = self._shared_cache.get(key)
+            if lines is None:
+                lines = self._process_template([node], variables)
+                self._shared_cache.set(key, lines)
+            else:
+                self._shared_cache.reused.append('%s:%s' % (os.path.basename(plan.path), node.name or index))
+
+        return lines
+
+    def _render_nodes(self, nodes, variables):
+        """ Renders each of the top level nodes
 
-        return {'lines': lines,
-                'text': '\n'.join(lines),
-                'included_files': include_files}
+        If more than one worker is configured, the nodes are rendered by a
+        pool of worker processes.  The pool is forked after the plans are
+        compiled so each worker inherits them along with a copy-on-write
+        snapshot of the variables.  Results are collected in submission
+        order so the output is identical to the serial render.
+
+        :returns: generator that yields the list of lines for each node
+        """
+        results = common.forked_map(lambda node: self._render_node(node, variables), nodes, self.workers)
+        try:
+            for lines, report in results:
+                if report is not None:
+                    self._profile.merge(report)
+                yield lines
+        finally:
+            results.close()
+
+    def _render_node(self, node, variables):
+        """ Renders a top level node
+
+        When profiling, the statistics are collected separately for each
+        node, which might be rendered by a worker process, and returned to
+        be merged into the profile of the task.
+
+        :returns: tuple of the list of lines and the profile report or None
+        """
+        if self._profile is None:
+            return self._process_template([node], variables), None
+
+        profile, self._profile = self._profile, RenderProfile(self.source_dir)
+        try:
+            lines = self._process_template([node], variables)
+            return lines, self._profile.report()
+        finally:
+            self._profile = profile
+
+    def _fingerprint(self, names, variables):
+        """ Generates a fingerprint of the values for a set of variables
+
+        :param names: The set of variable names or None
+        :param variables: The variables used to render the templates
+
+        :returns: sha1 hex digest of the values or None if the values cannot
+            be fingerprinted reliably
+        """
+        if names is None:
+            return None
+
+        values = list()
+        for name in sorted(names):
+            if name not in variables:
+                values.append([name])
+                continue
+            value = variables[name]
+            if self._contains_template(value):
+                return None
+            values.append([name, value])
+
+        try:
+            data = json.dumps(values, sort_keys=True)
+        except (TypeError, ValueError):
+            return None
+
+        return hashlib.sha1(to_bytes(data, errors='surrogate_or_strict')).hexdigest()
+
+    def _contains_template(self, value):
+        if hasattr(value, '__UNSAFE__'):
+            return False
+        elif isinstance(value, string_types):
+            return common.is_template(value, self._templar.environment)
+        elif isinstance(value, Mapping):
+            return any(self._contains_template(item) for item in value.values())
+        elif isinstance(value, (list, tuple)):
+            return any(self._contains_template(item) for item in value)
+        return False
 
+    def _write_dest(self, lines, dest):
+        """ Streams the rendered lines to the destination file
+
+        The lines are written to a temporary file in the destination
+        directory and moved into place only if the content differs from the
+        existing file.  The mode of an existing file is kept and a new file
+        is created according to the umask.
+
+        :param lines: Iterable of rendered configuration lines
+        :param dest: The path to write the configuration to
+
+        :returns: dict with the result of the write
+        """
+        dest = os.path.expanduser(dest)
+        dirname = os.path.dirname(os.path.abspath(dest))
+        if not os.path.isdir(dirname):
+            raise AnsibleError('destination directory %s does not exist' % dirname)
+
+        checksum = hashlib.sha1()
+        size = 0
+
+        fd, tmp_path = tempfile.mkstemp(dir=dirname, prefix='.config_template.')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                for index, line in enumerate(lines):
+                    if index:
+                        line = '\n' + line
+                    data = to_bytes(line, errors='surrogate_or_strict')
+                    checksum.update(data)
+                    f.write(data)
+                    size += len(data)
+
+            checksum = checksum.hexdigest()
+            changed = checksum != self._file_checksum(dest)
+
+            if changed and not self._play_context.check_mode:
+                os.chmod(tmp_path, common.file_mode(dest))
+                os.rename(tmp_path, dest)
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+
+        return {'changed': changed, 'dest': dest, 'checksum': checksum, 'size': size}
+
+    def _file_checksum(self, path):
+        if not os.path.isfile(path):
+            return None
+        checksum = hashlib.sha1()
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(65536), b''):
+                checksum.update(chunk)
+        return checksum.hexdigest()
 
     def _check_file(self, filename, matches):
         """ Checks the file against a list of matches
@@ -89,14 +1132,7 @@ class ActionModule(ActionBase):
 
         :returns: True if the filename should be ignored otherwise False
         """
-        if isinstance(matches, string_types):
-            matches = [matches]
-        if not isinstance(matches, list):
-            raise AnsibleError("matches must be a valid list")
-        for pattern in matches:
-            if re.search(r'%s' % pattern, filename):
-                return True
-        return False
+        return compile_matcher(matches)(filename)
 
     def should_include(self, filename):
         if self.include_files:
@@ -110,260 +1146,416 @@ class ActionModule(ActionBase):
 
     def included_files(self):
         include_files = list()
-        for filename in os.listdir(self.source_dir):
-            filename = os.path.join(self.source_dir, filename)
-
-            if not os.path.isfile(filename):
+        for filename in scan_directory(self.source_dir):
+            if self.should_exclude(filename):
+                warning('excluding file %s' % os.path.join(self.source_dir, filename))
                 continue
-            elif self.should_exclude(os.path.basename(filename)):
-                warning('excluding file %s' % filename)
-                continue
-            elif not self.should_include(os.path.basename(filename)):
-                warning('skipping file %s' % filename)
+            elif not self.should_include(filename):
+                warning('skipping file %s' % os.path.join(self.source_dir, filename))
                 continue
             else:
-                include_files.append(filename)
+                include_files.append(os.path.join(self.source_dir, filename))
         return include_files
 
-    def _process_template(self, contents, template_vars):
-        lines = list()
+    def _load_plan(self, path):
+        """ Returns the compiled plan for the template file
 
-        for item in contents:
-            name = item.get('name')
-
-            block = item.get('block')
-            include = item.get('include')
-
-            when = item.get('when')
-
-            if include:
-                if when is not None:
-                    conditional = "{%% if %s %%}True{%% else %%}False{%% endif %%}"
-                    if not self.template(conditional % when, template_vars, fail_on_undefined=False):
-                        display.vvvvv("include '%s' skipped due to conditional check failure" % name)
-                        continue
-                lines.extend(self._process_include(item, template_vars))
-
-            elif block:
-                loop = item.get('loop')
-                loop_data = None
-
-                loop_control = item.get('loop_control') or {'loop_var': 'item'}
-
-                if loop:
-                    loop_data = self.template(loop, template_vars, fail_on_undefined=False, convert_bare=True)
-                    if not loop_data:
-                        warning("block '%s' skipped due to missing loop var '%s'" % (name, loop))
-                        continue
-
-                values = list()
-
-                if isinstance(loop_data, collections.Mapping):
-                    for item_key, item_value in iteritems(loop_data):
-                        item_data = template_vars.copy()
-                        key = loop_control['loop_var']
-                        item_data[key] = {'key': item_key, 'value': item_value}
-
-                        if when is not None:
-                            conditional = "{%% if %s %%}True{%% else %%}False{%% endif %%}"
-                            if not self.template(conditional % when, item_data, fail_on_undefined=False):
-                                display.vvvvv("block '%s' skipped due to conditional check failure" % name)
-                                continue
-
-                        for entry in block:
-                            if 'block' in entry or 'include' in entry:
-                                templated_values = self.build([entry], item_data)
-                            elif 'lines' not in entry:
-                                raise AnsibleError("missing required block entry `lines` in dict")
-                            else:
-                                templated_values = self._process_block(entry, item_data)
-
-                            if templated_values:
-                                values.extend(templated_values)
-
-                elif isinstance(loop_data, collections.Iterable):
-                    for item_value in loop_data:
-                        item_data = template_vars.copy()
-                        key = loop_control['loop_var']
-                        item_data[key] = item_value
-
-                        if when is not None:
-                            conditional = "{%% if %s %%}True{%% else %%}False{%% endif %%}"
-                            if not self.template(conditional % when, item_data, fail_on_undefined=False):
-                                display.vvvvv("block '%s' skipped due to conditional check failure" % name)
-                                continue
-
-                        for entry in block:
-                            if 'block' in entry or 'include' in entry:
-                                templated_values = self.build([entry], item_data)
-                            elif 'lines' not in entry:
-                                raise AnsibleError("missing required block entry `lines` in list")
-                            else:
-                                templated_values = self._process_block(entry, item_data)
-
-                            if templated_values:
-                                values.extend(templated_values)
+        The plan is compiled at most once per run and process, see
+        load_compiled() in network_config/common.py.
 
-                else:
-                    for entry in block:
-                        if when is not None:
-                            conditional = "{%% if %s %%}True{%% else %%}False{%% endif %%}"
-                            if not self.template(conditional % when, template_vars, fail_on_undefined=False):
-                                display.vvvvv("block '%s' skipped due to conditional check failure" % name)
-                                continue
-
-                        if 'block' in entry or 'include' in entry:
-                            templated_values = self.build([entry], template_vars)
-                        elif 'lines' not in entry:
-                            raise AnsibleError("missing required block entry `lines`")
-                        else:
-                            templated_values = self._process_block(entry, template_vars)
-
-                        if templated_values:
-                            values.extend(templated_values)
-
-                if values:
-                    lines.extend(values)
+        :param path: The absolute path to the template file
+
+        :returns: an instance of TemplatePlan
+        """
+        return common.load_compiled(path, _PLAN_CACHE, _SHARED_PLANS, self._compile_plan)
+
+    def _compile_plan(self, path, mtime, digest):
+        display.vvvv('compiling template plan for %s' % path)
+        contents = self._loader.load_from_file(path, cache=False)
+        return TemplatePlan(path, mtime, digest, compile_template(contents, self._templar.environment))
+
+    def _check_conditional(self, node, data):
+        if node.when is None:
+            return True
+        with self._available_variables(data or {}):
+            return self._evaluate(node.when)
+
+    def _evaluate(self, conditional):
+        """ Evaluates a conditional using the active templar variables
+
+        The conditional is compiled once per process and rendered with the
+        templar variables, instead of being parsed again by the templar for
+        every node and loop item.  Conditionals that cannot be compiled or
+        fail to render are passed to the templar so that errors and
+        undefined variables are handled as before.
+        """
+        entry = _CONDITIONAL_CACHE.get(conditional)
+        if entry is None or entry[0] is not self._templar.environment:
+            entry = (self._templar.environment, compile_conditional(conditional, self._templar))
+            _CONDITIONAL_CACHE[conditional] = entry
+
+        template = entry[1]
+        if template is not None:
+            context = template.new_context(AnsibleJ2Vars(self._templar, template.globals), shared=True)
+            try:
+                result = ''.join(template.root_render_func(context))
+            except Exception:
+                # rendered again by the templar, which reports the error
+                result = None
+            if result in ('True', 'False'):
+                return result == 'True'
+
+        return self._template(conditional, fail_on_undefined=False)
+
+    def _template_loop(self, node, data):
+        """ Returns the value of the loop directive of the node
+
+        Loops that reference a defined variable holding a plain list or dict
+        return the value directly.  The templar would render the value to
+        text and convert it back with safe_eval, which gives an equal value.
+        All other loops are templated.
+        """
+        if node.loop not in _LOOP_CACHE:
+            _LOOP_CACHE[node.loop] = compile_loop(node.loop, self._templar.environment)
+
+        reference = _LOOP_CACHE[node.loop]
+        if reference is not None and reference[0] in data and self._is_plain(data[reference[0]]):
+            value = common.resolve_reference(reference, data, self._templar.environment)
+            if isinstance(value, (list, dict)) and is_literal(value):
+                return value
 
+        return self.template(node.loop, data, fail_on_undefined=False, convert_bare=True)
+
+    def _process_template(self, nodes, template_vars):
+        lines = list()
+
+        for node in nodes:
+            if self._profile is None:
+                values = self._process_node(node, template_vars)
             else:
-                values = self._process_block(item, template_vars)
-                if values:
-                    lines.extend(values)
+                values = self._profile.measure(node, self._process_node, template_vars)
 
-        return lines
+            if values:
+                lines.extend(values)
 
-    def _template_items(self, block, data):
-        name = block.get('name')
-        items = to_list(block['lines'])
+        return lines
 
-        required = block.get('required')
+    def _process_node(self, node, template_vars):
+        name = node.name
 
-        join = block.get('join')
-        join_delimiter = block.get('join_delimiter') or ' '
+        if isinstance(node, IncludeNode):
+            if not self._check_conditional(node, template_vars):
+                display.vvvvv("include '%s' skipped due to conditional check failure" % name)
+                self._record(skipped=1)
+                return []
+            return self._process_include(node, template_vars)
 
-        indent = block.get('indent')
+        elif isinstance(node, LinesNode):
+            return self._process_block(node, template_vars)
 
-        missing_key = block.get('missing_key') or 'warn'
-        if missing_key not in MISSING_KEY_OPTIONS:
-            raise AnsibleError('option missing_key expected one of %s, got %s' % (', '.join(MISSING_KEY_OPTIONS), missing_key))
+        loop_data = None
 
-        fail_on_undefined = missing_key == 'fail'
-        warn_on_missing_key = missing_key == 'warn'
+        if node.loop:
+            loop_data = self._template_loop(node, template_vars)
+            if not loop_data:
+                warning("block '%s' skipped due to missing loop var '%s'" % (name, node.loop))
+                return []
 
         values = list()
 
+        if isinstance(loop_data, Iterable):
+            scope = VariableScope(None, template_vars)
+            with self._available_variables(scope):
+                for item in self._filter_loop(node, loop_data, scope):
+                    scope[node.loop_var] = item
+                    values.extend(self._process_template(node.block, scope))
+
+        elif not self._check_conditional(node, template_vars):
+            display.vvvvv("block '%s' skipped due to conditional check failure" % name)
+            self._record(skipped=1)
+
+        else:
+            values.extend(self._process_template(node.block, template_vars))
+
+        return values
+
+    def _record(self, iterations=0, skipped=0):
+        if self._profile is not None:
+            self._profile.record(iterations, skipped)
+
+    def _loop_items(self, loop_data):
+        if isinstance(loop_data, Mapping):
+            return [{'key': key, 'value': value} for key, value in iteritems(loop_data)]
+        return loop_data
+
+    def _filter_loop(self, node, loop_data, scope):
+        """ Filters the loop data using the node conditional
+
+        The conditional is evaluated for every item in a single pass with
+        the loop scope already set as the templar variables.  The caller is
+        expected to have activated the scope using _available_variables.
+
+        :param node: The compiled block node
+        :param loop_data: The templated value of the loop directive
+        :param scope: The active scope to assign each loop item to
+
+        :returns: list of loop items that passed the conditional check
+        """
+        items = self._loop_items(loop_data)
+        if node.when is None:
+            self._record(iterations=len(items))
+            return items
+
+        kept = list()
         for item in items:
-            templated_value = self.template(item, data, fail_on_undefined=fail_on_undefined)
+            scope[node.loop_var] = item
+            if self._evaluate(node.when):
+                kept.append(item)
+            else:
+                display.vvvvv("block '%s' skipped due to conditional check failure" % node.name)
+
+        self._record(iterations=len(kept), skipped=len(items) - len(kept))
+        return kept
+
+    def _template_items(self, block, data):
+        name = block.name
+
+        fail_on_undefined = block.missing_key == 'fail'
+        warn_on_missing_key = block.missing_key == 'warn'
+
+        values = list()
+
+        plain = dict()
+
+        for line in block.lines:
+            templated_value = None
+            if line.parts is not None:
+                templated_value = self._format_line(line.parts, data, plain)
+            if templated_value is not None:
+                pass
+            elif line.is_template:
+                templated_value = self.template(line.value, data, fail_on_undefined=fail_on_undefined)
+            else:
+                templated_value = line.value
 
             if templated_value:
                 if '__omit_place_holder__' in templated_value:
                     continue
                 if isinstance(templated_value, string_types):
                     values.append(templated_value)
-                elif isinstance(templated_value, collections.Iterable):
+                elif isinstance(templated_value, Iterable):
                     values.extend(templated_value)
             else:
-                if required:
+                if block.required:
                     raise AnsibleError("block '%s' is missing required key" % name)
                 elif warn_on_missing_key:
-                    warning("line '%s' skipped due to missing key" % item)
+                    warning("line '%s' skipped due to missing key" % line.value)
 
-            if join and values:
-                values = [join_delimiter.join(values)]
+        if block.join and values:
+            values = [block.join_delimiter.join(values)]
 
-            if indent:
-                values = [(indent * ' ') + line.strip() for line in values]
+        if block.indent:
+            values = [(block.indent * ' ') + line.strip() for line in values]
 
         return values
 
-    def _process_block(self, block, data):
-        name = block.get('name')
-        when = block.get('when')
+    def _format_line(self, parts, data, plain):
+        """ Formats a compiled line without using the templar
 
-        loop = block.get('loop')
-        loop_data = None
+        The referenced variables must be defined and contain only plain
+        values with no templates in them.  If any part of the line cannot be
+        resolved in exactly the same way the templar would, this method
+        returns None and the line must be rendered by the templar.
 
-        loop_control = block.get('loop_control') or {'loop_var': 'item'}
+        :param parts: The compiled parts of the line
+        :param data: The variables used to render the line
+        :param plain: dict caching the result of the plain value check for
+            each variable name
 
+        :returns: the formatted line or None
+        """
+        env = self._templar.environment
         values = list()
+        unsafe = False
 
-        if when is not None:
-            conditional = "{%% if %s %%}True{%% else %%}False{%% endif %%}"
-            if not self.template(conditional % when, data, fail_on_undefined=False):
-                display.vvvv("block '%s' skipped due to conditional check failure" % name)
-                return values
+        for part in parts:
+            if isinstance(part, string_types):
+                values.append(part)
+                continue
 
-        if loop:
-            loop_data = self.template(loop, data, fail_on_undefined=False, convert_bare=True)
-            if not loop_data:
-                warning("block '%s' skipped due to missing loop var '%s'" % (name, loop))
-                return values
+            name, path = part
+            if name not in data:
+                return None
+
+            if name not in plain:
+                plain[name] = self._is_plain(data[name])
+            if not plain[name]:
+                return None
+
+            value = common.resolve_reference(part, data, env)
+
+            # a line holding a single variable returns the native value
+            # from the templar
+            if len(parts) == 1 and not path and not isinstance(value, string_types):
+                return None
+            if not isinstance(value, FORMAT_TYPES) or isinstance(value, jinja2.Undefined):
+                return None
+            unsafe = unsafe or hasattr(value, '__UNSAFE__')
+            values.append(to_text(value))
+
+        # the templar converts results that look like lists, dicts or
+        # booleans, leave those to the templar
+        result = ''.join(values)
+        if result.startswith(('{', '[')) or result in ('True', 'False'):
+            return None
+
+        # like the templar, a line that holds an unsafe value is unsafe
+        if unsafe:
+            return wrap_var(result)
+        return result
+
+    def _is_plain(self, value):
+        if hasattr(value, '__UNSAFE__') or value is None:
+            return True
+        elif isinstance(value, string_types):
+            return not common.is_template(value, self._templar.environment)
+        elif isinstance(value, (bool, float) + integer_types):
+            return True
+        elif isinstance(value, dict):
+            return all(self._is_plain(item) for item in value.values())
+        elif isinstance(value, (list, tuple)):
+            return all(self._is_plain(item) for item in value)
+        return False
 
-        if isinstance(loop_data, collections.Mapping):
-            for item_key, item_value in iteritems(loop_data):
-                item_data = data.copy()
-                key = loop_control['loop_var']
-                item_data[key] = {'key': item_key, 'value': item_value}
+    def _process_block(self, block, data):
+        name = block.name
+        loop_data = None
 
-                templated_values = self._template_items(block, item_data)
+        values = list()
 
-                if templated_values:
-                    values.extend(templated_values)
+        if not self._check_conditional(block, data):
+            display.vvvv("block '%s' skipped due to conditional check failure" % name)
+            self._record(skipped=1)
+            return values
 
-        elif isinstance(loop_data, collections.Iterable):
-            for item_value in loop_data:
-                item_data = data.copy()
-                key = loop_control['loop_var']
-                item_data[key] = item_value
+        if block.loop:
+            loop_data = self._template_loop(block, data)
+            if not loop_data:
+                warning("block '%s' skipped due to missing loop var '%s'" % (name, block.loop))
+                return values
 
-                templated_values = self._template_items(block, item_data)
+        if isinstance(loop_data, Iterable):
+            scope = VariableScope(None, data)
+            with self._available_variables(scope):
+                items = self._loop_items(loop_data)
+                for item in items:
+                    scope[block.loop_var] = item
 
-                if templated_values:
-                    values.extend(templated_values)
+                    templated_values = self._template_items(block, scope)
+
+                    if templated_values:
+                        values.extend(templated_values)
+
+            self._record(iterations=len(items))
 
         else:
             values = self._template_items(block, data)
 
         return values
 
-    def _process_include(self, item, variables):
-        name = item.get('name')
-        include = item['include']
-
-        src = self.template(include, variables)
-        source = self._find_needle('templates', src)
+    def _process_include(self, node, variables):
+        src = self.template(node.include, variables)
+        source = self._resolve_include(src)
 
-        when = item.get('when')
+        if source in self._include_stack:
+            raise AnsibleError('include cycle detected: %s' % ' -> '.join(self._include_stack + [source]))
 
-        if when:
-            conditional = "{%% if %s %%}True{%% else %%}False{%% endif %%}"
-            if not self.template(conditional % when, variables, fail_on_undefined=False):
-                display.vvvvv("include '%s' skipped due to conditional check failure" % name)
-                return []
-
-        display.display('including file %s' % source)
-        include_data = self._loader.load_from_file(source)
-
-        template_data = item.copy()
+        plan = self._load_plan(source)
 
         # replace include directive with block directive and contents of
         # included file.  this will preserve other values such as loop,
         # loop_control, etc
-        template_data.pop('include')
-        template_data['block'] = include_data
+        block = BlockNode(node.name, plan.nodes, None, node.loop, node.loop_var, None, node.pos)
 
-        return self.build([template_data], variables)
+        self._include_stack.append(source)
+        try:
+            return self._process_node(block, variables)
+        finally:
+            self._include_stack.pop()
 
-    def template(self, value, data=None, fail_on_undefined=False, convert_bare=False):
+    def _resolve_include(self, src):
+        """ Returns the path to the included template file
+
+        Include paths are resolved once per run and cached using the
+        templated file name as the key.
+        """
+        source = self._include_paths.get(src)
+        if source is None:
+            source = self._find_needle('templates', src)
+            display.display('including file %s' % source)
+            self._include_paths[src] = source
+        return source
+
+    def _check_includes(self, plan, parents=()):
+        """ Resolves the static includes in the plan and checks for cycles
+
+        Every unconditional include with a static file name is resolved
+        and compiled before rendering starts so include cycles are reported
+        up front.  Includes with templated file names or under a ``when`` or
+        ``loop`` are checked when rendered, as are the files that cannot be
+        found, so an include that is skipped never fails the task.
+
+        :param plan: The compiled plan to check
+        :param parents: The chain of files that included this plan
+        """
+        if plan.path in self._checked_includes:
+            return
+
+        parents = parents + (plan.path,)
+        for node in _iter_includes(plan.nodes):
+            if common.is_template(node.include, self._templar.environment):
+                continue
+            try:
+                source = self._resolve_include(node.include)
+            except AnsibleError:
+                # raised again by _process_include if the include is rendered
+                continue
+            if source in parents:
+                raise AnsibleError('include cycle detected: %s' % ' -> '.join(parents + (source,)))
+            self._check_includes(self._load_plan(source), parents)
+
+        self._checked_includes.add(plan.path)
+
+    @contextlib.contextmanager
+    def _available_variables(self, data):
+        """ Sets the templar variables for the duration of the context
+
+        If the variables are already active, the templar is left untouched
+        so nested calls using the same scope do not swap the templar state.
+        """
+        tmp_avail_vars = self._templar._available_variables
+        if tmp_avail_vars is data:
+            yield
+            return
+        self._templar.set_available_variables(data)
         try:
-            data = data or {}
-            tmp_avail_vars = self._templar._available_variables
-            self._templar.set_available_variables(data)
-            res = self._templar.template(value, convert_bare=convert_bare)
+            yield
+        finally:
+            self._templar.set_available_variables(tmp_avail_vars)
+
+    def _template(self, value, fail_on_undefined=False, convert_bare=False):
+        if self._profile is not None:
+            self._profile.templar_calls += 1
+
+        # loop scopes are updated in place so results must never be served
+        # from the templar cache
+        try:
+            return self._templar.template(value, convert_bare=convert_bare, cache=False)
         except AnsibleUndefinedVariable:
             if fail_on_undefined:
                 raise
-            res = None
-        finally:
-            self._templar.set_available_variables(tmp_avail_vars)
-        return res
+            return None
+
+    def template(self, value, data=None, fail_on_undefined=False, convert_bare=False):
+        with self._available_variables(data or {}):
+            return self._template(value, fail_on_undefined=fail_on_undefined, convert_bare=convert_bare)
@@ -0,0 +1,364 @@
+# -*- coding: utf-8 -*-
+
+# (c) 2018, Ansible by Red Hat, inc
+# GNU General Public License v3.0+ (see COPYING or https://www.gnu.org/licenses/gpl-3.0.txt)
+"""
+Code shared by the action plugins of the role.
+
+The role directories are not on the python path of the controller, so the
+action plugins load this module from its file, see ``load_module()`` in
+each plugin, and it is only ever loaded once per process.
+"""
+from __future__ import (absolute_import, division, print_function)
+__metaclass__ = type
+
+import os
+import re
+import pickle
+import hashlib
+import tempfile
+import multiprocessing
+
+from jinja2 import nodes, TemplateSyntaxError, Undefined
+
+from ansible import constants as C
+from ansible.module_utils.six import integer_types, string_types
+from ansible.module_utils._text import to_bytes, to_text
+
+try:
+    from __main__ import display
+except ImportError:
+    from ansible.utils.display import Display
+    display = Display()
+
+
+# the function and items processed by the forked workers of forked_map().
+# this is set immediately before the pool is created so the workers inherit
+# it
+_WORKER_STATE = None
+
+# comment tokens and banner expressions of the network config module,
+# imported on the first call to ignore_line()
+_IGNORE_RULES = None
+
+JINJA2_OVERRIDE = '#jinja2:'
+
+SECTION_BRACES_RE = re.compile(r'[{};]')
+
+
+class SharedCache(object):
+    """ Compiled data shared by all the worker processes of a run
+
+    Ansible forks a new worker process for each host a task runs on, so a
+    process wide cache is lost once the host is done.  The values are also
+    pickled to the local temporary directory of the run, which the
+    controller creates before forking the workers and removes when the run
+    completes, so each file is loaded and compiled once per run instead of
+    once per host.  Values are keyed by the path of the file and a digest of
+    its content.
+    """
+
+    def __init__(self, prefix):
+        self.prefix = prefix
+
+    def _filename(self, path, digest):
+        directory = C.DEFAULT_LOCAL_TMP
+        if not directory or not os.path.isdir(directory):
+            return None
+        key = hashlib.sha1(to_bytes('%s\0%s' % (path, digest), errors='surrogate_or_strict')).hexdigest()
+        return os.path.join(directory, '%s-%s' % (self.prefix, key))
+
+    def get(self, path, digest):
+        filename = self._filename(path, digest)
+        if filename is None:
+            return None
+        try:
+            with open(filename, 'rb') as f:
+                return pickle.load(f)
+        except (IOError, OSError, EOFError, ValueError, TypeError, AttributeError, ImportError,
+                pickle.UnpicklingError):
+            return None
+
+    def set(self, path, digest, value):
+        filename = self._filename(path, digest)
+        if filename is None:
+            return
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(filename), prefix='.%s.' % self.prefix)
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                pickle.dump(value, f, 2)
+            os.rename(tmp_path, filename)
+        except (IOError, OSError, TypeError, AttributeError, pickle.PicklingError) as exc:
+            display.vvvv('unable to share the compiled %s: %s' % (path, to_text(exc)))
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+
+
+def load_compiled(path, cache, shared, compile_file):
+    """ Returns the compiled form of a file
+
+    The value is taken from the process wide cache if the file has not been
+    modified since it was compiled.  If the mtime has changed, the content
+    hash is compared and the value is looked up in the shared cache of the
+    run before the file is compiled again.
+
+    :param path: The absolute path to the file
+    :param cache: The process wide dict of the compiled values keyed by path
+    :param shared: The SharedCache of the run
+    :param compile_file: callable that is passed the path, mtime and digest
+        of the file and returns the compiled value
+
+    :returns: the compiled value, a namedtuple with ``mtime`` and ``digest``
+        fields
+    """
+    mtime = os.stat(path).st_mtime
+    value = cache.get(path)
+
+    if value is not None and value.mtime == mtime:
+        return value
+
+    with open(path, 'rb') as f:
+        digest = hashlib.sha1(f.read()).hexdigest()
+
+    if value is None or value.digest != digest:
+        value = shared.get(path, digest)
+
+    if value is None:
+        value = compile_file(path, mtime, digest)
+        shared.set(path, digest, value)
+
+    value = value._replace(mtime=mtime)
+    cache[path] = value
+    return value
+
+
+def _process_pool(workers):
+    try:
+        context = multiprocessing.get_context('fork')
+    except AttributeError:
+        context = multiprocessing
+    return context.Pool(workers)
+
+
+def _run_worker(index):
+    function, items = _WORKER_STATE
+    return function(items[index])
+
+
+def forked_map(function, items, workers, chunksize=1):
+    """ Applies the function to every item
+
+    If more than one worker is requested, the items are processed by a pool
+    of worker processes forked when the first result is requested.  The
+    function and items are inherited by the workers rather than pickled, so
+    the function can be a bound method or a closure, only the results are
+    sent back.  Results are yielded in the order of the items so the output
+    is identical to the serial run, which is used if the pool cannot be
+    started.
+
+    :param function: callable applied to each item
+    :param items: The list of items
+    :param workers: The maximum number of processes
+    :param chunksize: The number of items sent to a worker at a time
+
+    :returns: generator of the results
+    """
+    global _WORKER_STATE
+
+    pool = None
+    previous = _WORKER_STATE
+    if workers > 1 and len(items) > 1:
+        _WORKER_STATE = (function, items)
+        try:
+            pool = _process_pool(min(workers, len(items)))
+        except (AssertionError, OSError) as exc:
+            _WORKER_STATE = previous
+            if C.ACTION_WARNINGS:
+                display.warning('unable to start worker processes, running serially: %s' % to_text(exc))
+
+    try:
+        if pool is None:
+            for item in items:
+                yield function(item)
+        else:
+            for result in pool.imap(_run_worker, range(len(items)), chunksize):
+                yield result
+    finally:
+        if pool is not None:
+            _WORKER_STATE = previous
+            pool.terminate()
+            pool.join()
+
+
+def is_template(value, environment):
+    """ Checks if the value is a string with any of the template markers of
+    the environment
+    """
+    if not isinstance(value, string_types):
+        return False
+    for marker in (environment.variable_start_string, environment.block_start_string, environment.comment_start_string):
+        if marker in value:
+            return True
+    return False
+
+
+def compile_line(value, environment, exclude=frozenset()):
+    """ Compiles a string that only performs variable substitution
+
+    The string is parsed and, if it consists solely of literal text and
+    references to variables or their attributes, it is converted into a
+    tuple of parts that can be formatted directly.  Each part is either a
+    literal string or a reference returned by compile_reference().  Strings
+    using filters, tests, function calls, statements or any other
+    expression return None and are always rendered by the templar.
+
+    :param value: The string to compile
+    :param environment: The jinja2 environment used to parse the string
+    :param exclude: Variable names that are never referenced directly
+
+    :returns: tuple of parts or None
+    """
+    if '\\' in value or '\n' in value or '\r' in value or value.startswith(JINJA2_OVERRIDE):
+        return None
+
+    try:
+        body = environment.parse(value).body
+    except TemplateSyntaxError:
+        return None
+
+    if len(body) != 1 or not isinstance(body[0], nodes.Output):
+        return None
+
+    parts = list()
+    for node in body[0].nodes:
+        if isinstance(node, nodes.TemplateData):
+            parts.append(node.data)
+        else:
+            reference = compile_reference(node)
+            if reference is None or reference[0] in exclude:
+                return None
+            parts.append(reference)
+    return tuple(parts)
+
+
+def compile_reference(node):
+    """ Compiles an expression that only references a variable
+
+    The reference is a (name, path) tuple.  The path is a tuple of
+    (key, is_item) items, is_item is True for subscripts such as
+    ``item['name']`` or ``name[0]`` and False for attributes such as
+    ``item.name``.
+
+    :param node: The jinja2 expression node
+
+    :returns: the reference or None
+    """
+    path = list()
+    while not isinstance(node, nodes.Name):
+        if isinstance(node, nodes.Getattr):
+            path.append((node.attr, False))
+        elif isinstance(node, nodes.Getitem) and isinstance(node.arg, nodes.Const):
+            key = node.arg.value
+            if not isinstance(key, string_types + integer_types) or isinstance(key, bool):
+                return None
+            path.append((key, True))
+        else:
+            return None
+        node = node.node
+
+    if node.ctx != 'load':
+        return None
+    return (node.name, tuple(reversed(path)))
+
+
+def resolve_reference(reference, variables, environment):
+    """ Resolves a compiled reference the way jinja2 would
+
+    :param reference: The reference returned by compile_reference()
+    :param variables: The variables the reference is resolved against
+    :param environment: The jinja2 environment of the templar
+
+    :returns: the value, an Undefined instance if the reference is
+        undefined or None if the variable is not set
+    """
+    name, path = reference
+    if name not in variables:
+        return None
+
+    value = variables[name]
+    for key, is_item in path:
+        value = environment.getitem(value, key) if is_item else environment.getattr(value, key)
+        if isinstance(value, Undefined):
+            break
+    return value
+
+
+def file_mode(path):
+    """ Returns the mode of path, or the default mode of a new file
+
+    This is the mode the copy module would leave the file with, the mode of
+    an existing file is kept and new files are created according to the
+    umask.
+    """
+    try:
+        return os.stat(path).st_mode & 0o7777
+    except OSError:
+        umask = os.umask(0)
+        os.umask(umask)
+        return 0o666 & ~umask
+
+
+def ignore_line(text):
+    """ Returns True for comments and the banner lines of the command output
+
+    This is the same check as NetworkConfig does, with the comment tokens
+    tested in a single call.  The network config module is only imported
+    the first time a line is checked.
+    """
+    global _IGNORE_RULES
+    if _IGNORE_RULES is None:
+        from ansible.module_utils.network.common.config import DEFAULT_COMMENT_TOKENS, DEFAULT_IGNORE_LINES_RE
+        _IGNORE_RULES = (tuple(DEFAULT_COMMENT_TOKENS), tuple(DEFAULT_IGNORE_LINES_RE))
+
+    tokens, regexes = _IGNORE_RULES
+    if text.startswith(tokens):
+        return True
+    for regex in regexes:
+        if regex.match(text):
+            return True
+    return False
+
+
+def iter_config_lines(lines):
+    """ Yields the configuration lines along with their nesting depth
+
+    Each line that is not a comment or a bare brace is yielded as a
+    ``(line, stripped, depth)`` tuple, where ``depth`` is the number of
+    sections the line is nested under.  The hierarchy is based on
+    indentation, sections opened with ``{`` are only closed by the matching
+    ``}`` so brace delimited configurations such as junos and vyos are
+    handled regardless of their indentation.
+
+    :param lines: An iterable of configuration lines without line endings
+    """
+    # each frame is [indent, braced]
+    stack = list()
+
+    for line in lines:
+        stripped = line.strip()
+
+        if stripped.startswith('}'):
+            while stack:
+                if stack.pop()[1]:
+                    break
+
+        text = SECTION_BRACES_RE.sub('', stripped).strip()
+        if not text or ignore_line(text):
+            continue
+
+        indent = len(line) - len(line.lstrip())
+        while stack and not stack[-1][1] and stack[-1][0] >= indent:
+            stack.pop()
+
+        yield line, stripped, len(stack)
+        stack.append([indent, stripped.endswith('{')])
@@ -0,0 +1,97 @@
+# -*- coding: utf-8 -*-
+
+# (c) 2018, Ansible by Red Hat, inc
+# GNU General Public License v3.0+ (see COPYING or https://www.gnu.org/licenses/gpl-3.0.txt)
+"""
+Concurrent configuration fetch used by the config_fetch action.
+
+This module uses the python 3 coroutine syntax, so config_fetch only loads
+it when it runs on python 3 and asyncssh is installed.
+"""
+import os
+import time
+import asyncio
+import tempfile
+
+import asyncssh
+
+from ansible.module_utils._text import to_text
+from ansible.errors import AnsibleError
+
+
+CHUNK_SIZE = 64 * 1024
+
+
+async def fetch_config(target, semaphore, known_hosts=(), timeout=None):
+    """ Fetches the configuration of a single device
+
+    The command output is streamed to a temporary file next to the
+    destination as it arrives and the file is moved into place once
+    the command has completed successfully.  The file is given the mode of
+    the target, which config_fetch sets to the mode of the existing
+    destination or the default mode of a new file.
+
+    :returns: dict with the result for the host
+    """
+    started = time.time()
+    result = {'path': target.path}
+    tmp_path = None
+
+    async with semaphore:
+        try:
+            options = dict(port=target.port)
+            if target.username:
+                options['username'] = target.username
+            if target.password:
+                options['password'] = target.password
+            if target.private_key:
+                options['client_keys'] = [target.private_key]
+            if known_hosts != ():
+                options['known_hosts'] = known_hosts
+
+            conn = await asyncio.wait_for(asyncssh.connect(target.host, **options), timeout)
+            async with conn:
+                process = await conn.create_process(target.command, encoding=None)
+
+                fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(target.path), prefix='.fetch.')
+                size = 0
+                with os.fdopen(fd, 'wb') as f:
+                    while True:
+                        data = await asyncio.wait_for(process.stdout.read(CHUNK_SIZE), timeout)
+                        if not data:
+                            break
+                        f.write(data)
+                        size += len(data)
+
+                status = await process.wait()
+                if status.exit_status:
+                    raise AnsibleError('command `%s` exited with status %s'
+                                       % (target.command, status.exit_status))
+
+            os.chmod(tmp_path, target.mode)
+            os.rename(tmp_path, target.path)
+            result['size'] = size
+
+        # a failure to fetch from one device must never abort the others
+        except Exception as exc:
+            result['failed'] = True
+            result['msg'] = to_text(exc) or exc.__class__.__name__
+
+        finally:
+            if tmp_path and os.path.exists(tmp_path):
+                os.remove(tmp_path)
+
+    result['elapsed'] = round(time.time() - started, 3)
+    return target.name, result
+
+
+async def fetch_all(targets, concurrency, known_hosts=(), timeout=None):
+    """ Fetches the configuration of all targets concurrently
+
+    At most ``concurrency`` SSH sessions are open at any time.
+
+    :returns: dict of the results keyed by target name
+    """
+    semaphore = asyncio.Semaphore(concurrency)
+    tasks = [fetch_config(t, semaphore, known_hosts, timeout) for t in targets]
+    return dict(await asyncio.gather(*tasks))
@@ -0,0 +1,340 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# (c) 2018, Ansible by Red Hat, inc
+# GNU General Public License v3.0+ (see COPYING or https://www.gnu.org/licenses/gpl-3.0.txt)
+"""
+Benchmarks the config_template and config_parser actions offline.
+
+Every case runs the ActionModule of the plugin directly against synthetic
+variables or a synthetic running configuration of the requested size and
+reports the throughput in lines per second, the peak resident memory and
+the number of values the templar was asked to template.  Each case runs in
+a new interpreter, like a forked worker would, and also reports the time it
+takes to import the plugin once ansible is loaded and the duration of its
+first run, which includes loading and compiling the templates or parser.
+
+    python tests/benchmark/bench.py --sizes 1000,10000,100000,500000
+
+The results are compared to baseline.json.  A case regresses when its
+output differs from the baseline or when it calls the templar more often.
+
+With --check every case is run a second time with the compiled fast paths
+of both plugins disabled.  The output must be identical and the speedup of
+the fast paths, the ratio of the two durations, must not drop by more than
+the tolerance for cases that run for at least a second.  Both runs are made
+on the same machine, so the ratio can be compared with the baseline recorded
+on another one.
+
+Throughput, memory and import time depend on the machine and are only
+compared with --absolute, once the baseline has been refreshed with
+--update-baseline on the machine that runs the comparison.  A case then
+also regresses when its throughput drops or its peak memory or import time
+grows by more than the tolerance.
+"""
+from __future__ import (absolute_import, division, print_function)
+
+import os
+import sys
+import json
+import shutil
+import hashlib
+import argparse
+import tempfile
+import importlib
+import compileall
+import subprocess
+
+from timeit import default_timer as timer
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, HERE)
+
+# imported once the benchmark directory is on the path
+synthetic = importlib.import_module('synthetic')
+
+BASELINE = os.path.join(HERE, 'baseline.json')
+
+ACTION_PLUGINS = os.path.join(HERE, '..', '..', 'action_plugins')
+
+DEFAULT_SIZES = '1000,10000,100000'
+
+DEFAULT_PROVIDERS = 'ios,junos'
+
+KINDS = ('template', 'parse', 'parse_file', 'batch')
+
+# batch cases split their size into configurations of this many lines, one
+# per host
+BATCH_HOST_LINES = 1000
+
+DEFAULT_TOLERANCE = 0.25
+
+# import times are a few milliseconds, so they are allowed this much on top
+# of the tolerance
+IMPORT_SLACK_MS = 2.0
+
+# the speedup of shorter runs depends more on the load of the machine than
+# on the code, so it is not compared
+MIN_SPEEDUP_SECONDS = 1.0
+
+# the parser file used for each configuration style
+PARSERS = {
+    'indented': 'ios.yaml',
+    'braced': 'junos.yaml',
+}
+
+
+def peak_rss():
+    """ Returns the peak resident memory of the process in MB
+    """
+    import resource
+    usage = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # linux reports the value in KB, macos in bytes
+    if sys.platform == 'darwin':
+        usage //= 1024
+    return round(usage / 1024.0, 1)
+
+
+def case_names(kinds, providers, sizes):
+    names = list()
+    for size in sizes:
+        for kind in kinds:
+            if kind == 'template':
+                names.append('template/%d' % size)
+            else:
+                names.extend('%s/%s/%d' % (kind, provider, size) for provider in providers)
+    return names
+
+
+def disable_fast_paths():
+    """ Makes both plugins use the templar for every value
+    """
+    import fixtures
+    config_template = fixtures.load_plugin('config_template')
+    config_template.compile_line = lambda value, environment: None
+    config_template.compile_conditional = lambda value, templar: None
+    config_template.compile_loop = lambda value, environment: None
+    fixtures.load_plugin('config_parser').compile_reference = lambda value, environment: None
+
+
+def run_case(name, repeat):
+    """ Runs a single case in the current process
+
+    The inputs are generated before the first run, so the memory they use
+    is reported as ``setup_rss_mb``.  The case is run ``repeat`` times with
+    a new ActionModule each time and the fastest run is reported.
+    """
+    import fixtures
+    fixtures.load_worker_modules()
+
+    parts = name.split('/')
+    kind, size = parts[0], int(parts[-1])
+
+    started = timer()
+    plugin = fixtures.load_plugin('config_template' if kind == 'template' else 'config_parser')
+    import_ms = (timer() - started) * 1000
+
+    tmp_path = None
+    tmp_dir = None
+    if kind == 'template':
+        args = {'source_dir': os.path.join(HERE, 'source')}
+        task_vars = synthetic.generate_vars(size)
+    else:
+        provider = parts[1]
+        args = {'src': PARSERS[synthetic.style(provider)]}
+        if kind == 'batch':
+            tmp_dir = tempfile.mkdtemp(prefix='bench.')
+            hosts = ['bench%d' % index for index in range(max(size // BATCH_HOST_LINES, 1))]
+            lines = 0
+            for host in hosts:
+                config = synthetic.generate_config(provider, BATCH_HOST_LINES, hostname=host)
+                with open(os.path.join(tmp_dir, host), 'w') as f:
+                    f.write(config)
+                lines += config.count('\n')
+            del config
+            args.update({'output_dir': tmp_dir, 'hosts': hosts})
+        elif kind == 'parse_file':
+            config = synthetic.generate_config(provider, size)
+            fd, tmp_path = tempfile.mkstemp(prefix='bench.', suffix='.cfg')
+            with os.fdopen(fd, 'w') as f:
+                f.write(config)
+            args['output_file'] = tmp_path
+            lines = config.count('\n')
+            del config
+        else:
+            config = synthetic.generate_config(provider, size)
+            args['output'] = config
+            lines = config.count('\n')
+        task_vars = dict()
+
+    setup_rss = peak_rss()
+    timings = list()
+    calls = None
+
+    try:
+        for index in range(repeat):
+            action, templar = fixtures.make_action(plugin, dict(args))
+            started = timer()
+            result = action.run(task_vars=task_vars)
+            timings.append(timer() - started)
+
+            if result.get('failed') or result.get('failed_hosts'):
+                raise RuntimeError('%s failed: %s' % (name, result.get('msg') or result['failed_hosts']))
+            if calls is None:
+                calls = templar.calls
+    finally:
+        if tmp_path:
+            os.remove(tmp_path)
+        if tmp_dir:
+            shutil.rmtree(tmp_dir)
+
+    if kind == 'template':
+        lines = len(result['lines'])
+        output = result['text']
+    elif kind == 'batch':
+        output = json.dumps(result['hosts'], sort_keys=True)
+    else:
+        output = json.dumps(result['ansible_facts'], sort_keys=True)
+
+    elapsed = min(timings)
+    return {
+        'lines': lines,
+        'import_ms': round(import_ms, 1),
+        'first_seconds': round(timings[0], 4),
+        'seconds': round(elapsed, 4),
+        'lines_per_second': int(lines / max(elapsed, 1e-6)),
+        'peak_rss_mb': peak_rss(),
+        'setup_rss_mb': setup_rss,
+        'templar_calls': calls,
+        'digest': hashlib.sha1(output.encode('utf-8')).hexdigest(),
+    }
+
+
+def spawn_case(name, repeat, slow=False):
+    """ Runs a case in a new interpreter so its peak memory is its own
+    """
+    command = [sys.executable, os.path.abspath(__file__), '--run-case', name, '--repeat', str(repeat)]
+    if slow:
+        command.append('--slow')
+    output = subprocess.check_output(command)
+    return json.loads(output.decode('utf-8').strip().splitlines()[-1])
+
+
+def compare(name, result, baseline, tolerance, absolute=False):
+    """ Returns the list of regressions of result against the baseline
+
+    Only the output, the templar calls and the speedup of the fast paths
+    are compared unless absolute is set.
+    """
+    regressions = list()
+    if baseline is None:
+        return regressions
+
+    if result['digest'] != baseline['digest']:
+        regressions.append('output differs from the baseline')
+    if result['templar_calls'] > baseline['templar_calls']:
+        regressions.append('templar calls %d > %d' % (result['templar_calls'], baseline['templar_calls']))
+    if 'speedup' in result and 'speedup' in baseline and result['seconds'] >= MIN_SPEEDUP_SECONDS and \
+            result['speedup'] < baseline['speedup'] * (1 - tolerance):
+        regressions.append('fast path speedup %.2f < %.2f' % (result['speedup'], baseline['speedup']))
+
+    if not absolute:
+        return regressions
+
+    if result['lines_per_second'] < baseline['lines_per_second'] * (1 - tolerance):
+        regressions.append('throughput %d < %d lines/s' % (result['lines_per_second'], baseline['lines_per_second']))
+    if result['peak_rss_mb'] > baseline['peak_rss_mb'] * (1 + tolerance):
+        regressions.append('peak rss %.1f > %.1f MB' % (result['peak_rss_mb'], baseline['peak_rss_mb']))
+    if 'import_ms' in baseline and \
+            result['import_ms'] > baseline['import_ms'] * (1 + tolerance) + IMPORT_SLACK_MS:
+        regressions.append('import time %.1f > %.1f ms' % (result['import_ms'], baseline['import_ms']))
+    return regressions
+
+
+def load_baseline(path):
+    if not os.path.exists(path):
+        return {'cases': {}}
+    with open(path) as f:
+        return json.load(f)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n')[0])
+    parser.add_argument('--sizes', default=DEFAULT_SIZES, help='comma separated configuration sizes in lines')
+    parser.add_argument('--providers', default=DEFAULT_PROVIDERS,
+                        help='comma separated providers to generate configurations for, or all')
+    parser.add_argument('--kinds', default=','.join(KINDS), help='comma separated kinds of cases to run')
+    parser.add_argument('--repeat', type=int, default=1, help='runs of each case, the fastest is reported')
+    parser.add_argument('--baseline', default=BASELINE, help='path of the baseline results')
+    parser.add_argument('--tolerance', type=float, help='allowed relative speedup, throughput and memory change')
+    parser.add_argument('--update-baseline', action='store_true', help='store the results as the baseline')
+    parser.add_argument('--check', action='store_true', help='compare the output with the fast paths disabled')
+    parser.add_argument('--absolute', action='store_true',
+                        help='also compare the throughput, memory and import time with the baseline')
+    parser.add_argument('--run-case', help=argparse.SUPPRESS)
+    parser.add_argument('--slow', action='store_true', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.run_case:
+        if args.slow:
+            disable_fast_paths()
+        result = run_case(args.run_case, args.repeat)
+        print(json.dumps(result, sort_keys=True))
+        return 0
+
+    providers = synthetic.providers() if args.providers == 'all' else args.providers.split(',')
+    sizes = [int(size) for size in args.sizes.split(',')]
+    names = case_names(args.kinds.split(','), providers, sizes)
+
+    # ansible writes the bytecode of the plugins the first time they are
+    # loaded, so the import time of a worker never includes compiling them
+    compileall.compile_dir(ACTION_PLUGINS, quiet=1)
+
+    baseline = load_baseline(args.baseline)
+    tolerance = args.tolerance
+    if tolerance is None:
+        tolerance = baseline.get('tolerance', DEFAULT_TOLERANCE)
+
+    print('%-28s %9s %9s %9s %12s %9s %9s %9s' % ('case', 'lines', 'import ms', 'first', 'seconds',
+                                                  'lines/s', 'rss MB', 'templar'))
+
+    failed = 0
+    for name in names:
+        result = spawn_case(name, args.repeat)
+        print('%-28s %9d %9.1f %9.3f %9.3f %12d %9.1f %9d' % (
+            name, result['lines'], result['import_ms'], result['first_seconds'], result['seconds'],
+            result['lines_per_second'], result['peak_rss_mb'], result['templar_calls']))
+
+        problems = list()
+        if args.check:
+            slow = spawn_case(name, args.repeat, slow=True)
+            if slow['digest'] != result['digest']:
+                problems.append('output differs with the fast paths disabled')
+            else:
+                result['speedup'] = round(slow['seconds'] / max(result['seconds'], 1e-6), 2)
+                print('%-28s %9s %9s %9s %9.3f %12d %9s %9d %8.2fx' % (
+                    '  without fast paths', '', '', '', slow['seconds'], slow['lines_per_second'], '',
+                    slow['templar_calls'], result['speedup']))
+
+        if not args.update_baseline:
+            problems.extend(compare(name, result, baseline['cases'].get(name), tolerance, args.absolute))
+
+        for problem in problems:
+            print('  REGRESSION: %s' % problem)
+        if problems:
+            failed += 1
+
+        baseline['cases'][name] = result
+
+    if args.update_baseline:
+        baseline['tolerance'] = tolerance
+        with open(args.baseline, 'w') as f:
+            json.dump(baseline, f, indent=2, sort_keys=True)
+            f.write('\n')
+        print('baseline written to %s' % args.baseline)
+
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
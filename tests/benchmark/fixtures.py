@@ -0,0 +1,116 @@
+# -*- coding: utf-8 -*-
+
+# (c) 2018, Ansible by Red Hat, inc
+# GNU General Public License v3.0+ (see COPYING or https://www.gnu.org/licenses/gpl-3.0.txt)
+"""
+Stand-ins for the task, play context and templar that ansible hands to an
+action plugin, so the plugins can be run without a playbook, inventory or
+connection.
+"""
+from __future__ import (absolute_import, division, print_function)
+
+import os
+import sys
+import tempfile
+import importlib
+
+from ansible.parsing.dataloader import DataLoader
+from ansible.template import Templar
+
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+ACTION_PLUGINS = os.path.join(HERE, '..', '..', 'action_plugins')
+
+# modules a worker process has already imported by the time it loads an
+# action plugin, they are not part of the import time of the plugin
+WORKER_MODULES = (
+    'ansible.executor.task_executor',
+    'ansible.plugins.action',
+    'ansible.template',
+)
+
+
+class StubTask(object):
+    """ The attributes of a task used by the action plugins
+
+    The search path makes ``_find_needle`` look up parsers and template
+    includes under the benchmark directory the same way it does under a
+    role.
+    """
+
+    async_val = 0
+
+    def __init__(self, args, search_path=None):
+        self.args = args
+        self._search_path = search_path or [HERE]
+
+    def get_search_path(self):
+        return self._search_path
+
+
+class StubPlayContext(object):
+
+    check_mode = False
+
+
+class StubShell(object):
+
+    tmpdir = tempfile.gettempdir()
+
+
+class StubConnection(object):
+    """ A connection whose remote temporary directory already exists
+    """
+
+    _shell = StubShell()
+
+
+class CountingTemplar(Templar):
+    """ Templar that counts the values it is asked to template
+
+    Only calls made from outside the templar are counted, the recursive
+    calls it makes for the items of lists and dicts are not.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super(CountingTemplar, self).__init__(*args, **kwargs)
+        self.calls = 0
+        self._depth = 0
+
+    def template(self, *args, **kwargs):
+        if not self._depth:
+            self.calls += 1
+        self._depth += 1
+        try:
+            return super(CountingTemplar, self).template(*args, **kwargs)
+        finally:
+            self._depth -= 1
+
+
+def load_worker_modules():
+    for name in WORKER_MODULES:
+        importlib.import_module(name)
+
+
+def load_plugin(name):
+    """ Imports the action plugin module from the role
+    """
+    if ACTION_PLUGINS not in sys.path:
+        sys.path.insert(0, ACTION_PLUGINS)
+    return importlib.import_module(name)
+
+
+def make_action(plugin, args, search_path=None):
+    """ Returns an instance of the plugin ActionModule for a task with args
+
+    :param plugin: The action plugin module
+    :param args: The task arguments
+
+    :returns: tuple of the ActionModule and its CountingTemplar
+    """
+    loader = DataLoader()
+    templar = CountingTemplar(loader=loader, variables={})
+    action = plugin.ActionModule(StubTask(args, search_path), StubConnection(), StubPlayContext(),
+                                 loader, templar, None)
+    return action, templar
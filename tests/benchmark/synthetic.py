@@ -0,0 +1,144 @@
+# -*- coding: utf-8 -*-
+
+# (c) 2018, Ansible by Red Hat, inc
+# GNU General Public License v3.0+ (see COPYING or https://www.gnu.org/licenses/gpl-3.0.txt)
+"""
+Generates synthetic running configurations and template variables of a
+given size.  The output only depends on the arguments so every run of the
+benchmark works on exactly the same data.
+"""
+from __future__ import (absolute_import, division, print_function)
+
+import os
+
+
+PROVIDERS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..', 'providers')
+
+# the configuration style and the interface name format of each provider,
+# providers not listed here use the defaults
+STYLES = {
+    'junos': 'braced',
+    'vyos': 'braced',
+}
+
+INTERFACE_NAMES = {
+    'asa': 'GigabitEthernet0/%d',
+    'eos': 'Ethernet%d',
+    'ios': 'GigabitEthernet0/%d',
+    'iosxr': 'GigabitEthernet0/0/0/%d',
+    'junos': 'ge-0/0/%d',
+    'nxos': 'Ethernet1/%d',
+    'vyos': 'eth%d',
+}
+
+DEFAULT_INTERFACE_NAME = 'Ethernet%d'
+
+
+def providers():
+    """ Returns the names of the providers shipped with the role
+    """
+    return sorted(name for name in os.listdir(PROVIDERS_DIR)
+                  if os.path.isdir(os.path.join(PROVIDERS_DIR, name)))
+
+
+def style(provider):
+    return STYLES.get(provider, 'indented')
+
+
+def _address(index):
+    return '10.%d.%d.1' % (index // 256 % 256, index % 256)
+
+
+def generate_config(provider, lines, hostname='bench01'):
+    """ Returns a running configuration of about the given number of lines
+
+    Indented configurations use the ios layout with ``!`` separators,
+    braced configurations use the junos layout.  Both hold the same
+    system settings, interfaces, vlans and bgp neighbors so the parsers
+    under ``parsers/`` extract the same facts from either.
+    """
+    interface = INTERFACE_NAMES.get(provider, DEFAULT_INTERFACE_NAME)
+
+    if style(provider) == 'braced':
+        count = max(lines // 11, 1)
+        config = ['system {', '    host-name %s;' % hostname, '    domain-name example.com;', '}']
+        config.append('interfaces {')
+        for index in range(count):
+            config.extend([
+                '    %s {' % (interface % index),
+                '        description "port %d";' % index,
+                '        mtu %d;' % (1500 + index % 8000),
+                '        unit 0 {',
+                '            family inet {',
+                '                address %s/24;' % _address(index),
+                '            }',
+                '        }',
+                '    }',
+            ])
+        config.append('}')
+        config.append('vlans {')
+        for index in range(1, count // 2 + 1):
+            config.extend(['    vlan%d {' % index, '        vlan-id %d;' % index, '    }'])
+        config.append('}')
+        config.extend(['protocols {', '    bgp {', '        group peers {', '            local-as 65000;'])
+        for index in range(count // 4):
+            config.append('            neighbor %s;' % _address(index))
+        config.extend(['        }', '    }', '}'])
+    else:
+        count = max(lines // 8, 1)
+        config = ['!', 'hostname %s' % hostname, 'ip domain-name example.com', '!']
+        for index in range(count):
+            config.extend([
+                'interface %s' % (interface % index),
+                ' description port %d' % index,
+                ' mtu %d' % (1500 + index % 8000),
+                ' ip address %s 255.255.255.0' % _address(index),
+                ' no shutdown' if index % 2 else ' shutdown',
+                '!',
+            ])
+        for index in range(1, count // 2 + 1):
+            config.extend(['vlan %d' % index, ' name vlan%d' % index, '!'])
+        config.append('router bgp 65000')
+        for index in range(count // 4):
+            config.append(' neighbor %s remote-as %d' % (_address(index), 65001 + index % 100))
+        config.extend(['!', 'end'])
+
+    return '\n'.join(config) + '\n'
+
+
+def generate_vars(lines, hostname='bench01'):
+    """ Returns the variables for the templates under ``source/``
+
+    The sizes of the interface, vlan, neighbor and access list collections
+    are chosen so the rendered configuration holds about the given number
+    of lines.
+    """
+    count = max(lines // 11, 1)
+
+    interfaces = dict()
+    for index in range(count):
+        interfaces['Ethernet%d' % index] = {
+            'description': 'port %d' % index,
+            'mtu': 1500 + index % 8000,
+            'enabled': bool(index % 2),
+            'addresses': [{'address': _address(index), 'netmask': '255.255.255.0'}],
+        }
+
+    return {
+        'inventory_hostname': hostname,
+        'hostname': hostname,
+        'domain_name': 'example.com',
+        'ntp_servers': ['10.255.0.1', '10.255.0.2'],
+        'syslog_servers': ['10.255.1.1', '10.255.1.2'],
+        'banner': 'authorized access only',
+        'interfaces': interfaces,
+        'vlans': [{'id': index, 'name': 'vlan%d' % index} for index in range(1, count + 1)],
+        'bgp_asn': 65000,
+        'bgp': {
+            'router_id': '10.255.255.1',
+            'neighbors': [{'address': _address(index), 'remote_as': 65001 + index % 100}
+                          for index in range(count)],
+        },
+        'acl_entries': [{'seq': (index + 1) * 10, 'source': _address(index)}
+                        for index in range(count * 2)],
+    }
@@ -0,0 +1,164 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# (c) 2018, Ansible by Red Hat, inc
+# GNU General Public License v3.0+ (see COPYING or https://www.gnu.org/licenses/gpl-3.0.txt)
+"""
+Simulates a fleet of network devices for testing and benchmarking the
+config_fetch action offline.
+
+Each simulated device listens on its own port on the loopback address and
+answers the configuration commands used by the providers with a synthetic
+configuration of the requested size.  Any username and password are
+accepted.
+
+    python tests/simulator/cli_simulator.py --devices 100 --lines 5000 \\
+        --inventory /tmp/simulated.ini
+
+The generated inventory can be used directly with the role tasks or with
+tests/simulator/fetch_benchmark.py.
+"""
+from __future__ import (absolute_import, division, print_function)
+
+import sys
+import argparse
+import asyncio
+
+import asyncssh
+
+
+COMMANDS = {
+    'show running-config': 'ios',
+    'show configuration': 'junos',
+}
+
+
+def generate_config(name, lines, style='ios'):
+    """ Returns a synthetic configuration of about the given number of lines
+    """
+    if style == 'junos':
+        config = ['system {', '    host-name %s;' % name, '}', 'interfaces {']
+        index = 0
+        while len(config) < lines - 1:
+            config.extend([
+                '    ge-0/0/%d {' % index,
+                '        description "port %d";' % index,
+                '        unit 0 {',
+                '            family inet {',
+                '                address 10.%d.%d.1/24;' % (index // 256 % 256, index % 256),
+                '            }',
+                '        }',
+                '    }',
+            ])
+            index += 1
+        config.append('}')
+    else:
+        config = ['!', 'hostname %s' % name, '!']
+        index = 0
+        while len(config) < lines:
+            config.extend([
+                'interface GigabitEthernet0/%d' % index,
+                ' description port %d' % index,
+                ' ip address 10.%d.%d.1 255.255.255.0' % (index // 256 % 256, index % 256),
+                ' no shutdown',
+                '!',
+            ])
+            index += 1
+        config.append('end')
+    return '\n'.join(config) + '\n'
+
+
+class DeviceServer(asyncssh.SSHServer):
+
+    def begin_auth(self, username):
+        return True
+
+    def password_auth_supported(self):
+        return True
+
+    def validate_password(self, username, password):
+        return True
+
+    def public_key_auth_supported(self):
+        return True
+
+    def validate_public_key(self, username, key):
+        return True
+
+
+def make_handler(name, args):
+    configs = dict()
+
+    async def handle(process):
+        command = (process.command or '').strip()
+        style = COMMANDS.get(command)
+        if style is None:
+            process.stderr.write('%% Invalid input: %s\n' % command)
+            process.exit(1)
+            return
+
+        if style not in configs:
+            configs[style] = generate_config(name, args.lines, style)
+        config = configs[style]
+
+        # the output is sent in chunks to simulate a slow device
+        for offset in range(0, len(config), args.chunk_size):
+            process.stdout.write(config[offset:offset + args.chunk_size])
+            if args.delay:
+                await asyncio.sleep(args.delay)
+            await process.stdout.drain()
+        process.exit(0)
+
+    return handle
+
+
+async def start(args):
+    key = asyncssh.generate_private_key('ssh-ed25519')
+    servers = list()
+    for index in range(args.devices):
+        name = 'device%d' % index
+        server = await asyncssh.create_server(
+            DeviceServer, args.address, args.port + index, server_host_keys=[key],
+            process_factory=make_handler(name, args))
+        servers.append(server)
+    return servers
+
+
+def write_inventory(path, args):
+    with open(path, 'w') as f:
+        f.write('[simulated]\n')
+        for index in range(args.devices):
+            f.write('device%d ansible_host=%s ansible_port=%d ansible_user=admin '
+                    'ansible_password=admin ansible_network_os=%s\n'
+                    % (index, args.address, args.port + index, args.network_os))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n')[0])
+    parser.add_argument('--devices', type=int, default=10, help='number of simulated devices')
+    parser.add_argument('--lines', type=int, default=1000, help='configuration lines per device')
+    parser.add_argument('--address', default='127.0.0.1', help='address to listen on')
+    parser.add_argument('--port', type=int, default=22200, help='port of the first device')
+    parser.add_argument('--chunk-size', type=int, default=16384, help='bytes sent per write')
+    parser.add_argument('--delay', type=float, default=0.0, help='seconds to wait between writes')
+    parser.add_argument('--network-os', default='ios', help='ansible_network_os in the inventory')
+    parser.add_argument('--inventory', help='write an inventory of the simulated devices to this path')
+    args = parser.parse_args()
+
+    if args.inventory:
+        write_inventory(args.inventory, args)
+
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    loop.run_until_complete(start(args))
+    print('simulating %d devices on %s:%d-%d' % (args.devices, args.address, args.port,
+                                                 args.port + args.devices - 1))
+    sys.stdout.flush()
+    try:
+        loop.run_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,87 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# (c) 2018, Ansible by Red Hat, inc
+# GNU General Public License v3.0+ (see COPYING or https://www.gnu.org/licenses/gpl-3.0.txt)
+"""
+Measures the throughput of the config_fetch action against simulated
+devices and checks every fetched configuration.
+
+The simulator is started in the same event loop, so no network devices are
+needed:
+
+    python tests/simulator/fetch_benchmark.py --devices 200 --lines 20000
+"""
+from __future__ import (absolute_import, division, print_function)
+
+import os
+import sys
+import time
+import shutil
+import argparse
+import asyncio
+import tempfile
+import importlib
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, HERE)
+sys.path.insert(0, os.path.join(HERE, '..', '..', 'action_plugins'))
+
+# imported once the simulator and plugin directories are on the path
+cli_simulator = importlib.import_module('cli_simulator')
+config_fetch = importlib.import_module('config_fetch')
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n')[0])
+    parser.add_argument('--devices', type=int, default=50)
+    parser.add_argument('--lines', type=int, default=5000)
+    parser.add_argument('--concurrency', type=int, default=config_fetch.DEFAULT_CONCURRENCY)
+    parser.add_argument('--port', type=int, default=22200)
+    parser.add_argument('--chunk-size', type=int, default=16384)
+    parser.add_argument('--delay', type=float, default=0.0)
+    parser.add_argument('--command', default='show running-config')
+    args = parser.parse_args()
+    args.address = '127.0.0.1'
+
+    dest = tempfile.mkdtemp(prefix='config_fetch.')
+    targets = [config_fetch.Target('device%d' % i, args.address, args.port + i, 'admin', 'admin',
+                                   None, args.command, os.path.join(dest, 'device%d' % i), False, 0o644)
+               for i in range(args.devices)]
+
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    try:
+        loop.run_until_complete(cli_simulator.start(args))
+
+        started = time.time()
+        results = loop.run_until_complete(
+            config_fetch.fetch.fetch_all(targets, args.concurrency, known_hosts=None))
+        elapsed = time.time() - started
+
+        style = cli_simulator.COMMANDS[args.command]
+        failed = 0
+        size = 0
+        for target in targets:
+            result = results[target.name]
+            expected = cli_simulator.generate_config(target.name, args.lines, style)
+            if result.get('failed'):
+                print('%s failed: %s' % (target.name, result['msg']))
+                failed += 1
+                continue
+            with open(target.path) as f:
+                if f.read() != expected:
+                    print('%s returned an unexpected configuration' % target.name)
+                    failed += 1
+            size += result['size']
+
+        print('fetched %d devices (%d failed) in %.2fs, %.1f devices/s, %.1f MB/s'
+              % (args.devices, failed, elapsed, args.devices / elapsed, size / elapsed / 1e6))
+        return 1 if failed else 0
+    finally:
+        loop.close()
+        shutil.rmtree(dest)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,18 @@
+# -*- coding: utf-8 -*-
+
+# (c) 2018, Ansible by Red Hat, inc
+# GNU General Public License v3.0+ (see COPYING or https://www.gnu.org/licenses/gpl-3.0.txt)
+from __future__ import (absolute_import, division, print_function)
+
+import os
+import sys
+
+ACTION_PLUGINS = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..', 'action_plugins')
+BENCHMARK = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'benchmark')
+
+# the action plugins are imported the same way the ansible plugin loader
+# does, as top level modules, and the synthetic configurations of the
+# benchmark are reused
+for path in (ACTION_PLUGINS, BENCHMARK):
+    if path not in sys.path:
+        sys.path.insert(0, path)
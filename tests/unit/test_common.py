@@ -0,0 +1,57 @@
+# -*- coding: utf-8 -*-
+
+# (c) 2018, Ansible by Red Hat, inc
+# GNU General Public License v3.0+ (see COPYING or https://www.gnu.org/licenses/gpl-3.0.txt)
+from __future__ import (absolute_import, division, print_function)
+
+import os
+
+import fixtures
+
+fixtures.load_worker_modules()
+common = fixtures.load_plugin('config_template').common
+
+
+def test_shared_cache_roundtrip(tmpdir, monkeypatch):
+    monkeypatch.setattr(common.C, 'DEFAULT_LOCAL_TMP', str(tmpdir))
+    cache = common.SharedCache('test')
+
+    assert cache.get('/path', 'digest') is None
+    cache.set('/path', 'digest', {'value': [1, 2]})
+    assert cache.get('/path', 'digest') == {'value': [1, 2]}
+    assert cache.get('/path', 'other') is None
+    assert cache.get('/other', 'digest') is None
+
+    # values that can not be pickled are not shared and leave no file behind
+    cache.set('/path', 'lambda', lambda: None)
+    assert cache.get('/path', 'lambda') is None
+    assert len(tmpdir.listdir()) == 1
+
+
+def test_shared_cache_without_local_tmp(tmpdir, monkeypatch):
+    monkeypatch.setattr(common.C, 'DEFAULT_LOCAL_TMP', str(tmpdir.join('missing')))
+    cache = common.SharedCache('test')
+    cache.set('/path', 'digest', 1)
+    assert cache.get('/path', 'digest') is None
+
+
+def test_forked_map_order():
+    offset = 10
+
+    # the function is inherited by the workers, a closure is not pickled
+    def square(item):
+        return item * item + offset, os.getpid()
+
+    results = list(common.forked_map(square, list(range(50)), 4))
+    assert [value for value, pid in results] == [item * item + offset for item in range(50)]
+    assert any(pid != os.getpid() for value, pid in results)
+
+
+def test_forked_map_serial_fallback(monkeypatch):
+    def fail(workers):
+        raise OSError('no processes')
+
+    monkeypatch.setattr(common, '_process_pool', fail)
+    results = list(common.forked_map(lambda item: (item * 2, os.getpid()), list(range(10)), 4))
+    assert results == [(item * 2, os.getpid()) for item in range(10)]
+    assert common._WORKER_STATE is None
@@ -0,0 +1,94 @@
+# -*- coding: utf-8 -*-
+
+# (c) 2018, Ansible by Red Hat, inc
+# GNU General Public License v3.0+ (see COPYING or https://www.gnu.org/licenses/gpl-3.0.txt)
+from __future__ import (absolute_import, division, print_function)
+
+import os
+import stat
+
+import pytest
+
+import fixtures
+import synthetic
+import config_backup
+
+
+@pytest.mark.parametrize('provider', ['ios', 'junos', 'vyos'])
+def test_split_chunks_bounded(provider):
+    data = synthetic.generate_config(provider, 50000).encode('utf-8')
+    chunks = config_backup.split_chunks(data)
+
+    assert b''.join(chunks) == data
+    # a chunk is cut at the first line past the limit
+    longest = max(len(line) for line in data.splitlines(True))
+    assert max(len(c) for c in chunks) < config_backup.MAX_CHUNK_SIZE + longest
+
+
+def test_split_chunks_nested_edit():
+    data = synthetic.generate_config('junos', 50000).encode('utf-8')
+    edited = data.replace(b'"port 2000"', b'"port 2000 uplink"')
+    assert edited != data
+
+    chunks = set(config_backup.split_chunks(data))
+    changed = [c for c in config_backup.split_chunks(edited) if c not in chunks]
+
+    assert len(changed) == 1
+    assert len(changed[0]) < len(data) // 10
+
+
+def test_split_chunks_single_line():
+    data = b'x' * (config_backup.MAX_CHUNK_SIZE * 2)
+    assert config_backup.split_chunks(data) == [data]
+
+
+def test_write_file_mode(tmpdir):
+    path = str(tmpdir.join('config'))
+
+    umask = os.umask(0o022)
+    try:
+        config_backup.write_file(path, b'hostname r1\n', config_backup.common.file_mode(path))
+    finally:
+        os.umask(umask)
+    assert stat.S_IMODE(os.stat(path).st_mode) == 0o644
+
+    os.chmod(path, 0o640)
+    config_backup.write_file(path, b'hostname r2\n', config_backup.common.file_mode(path))
+    assert stat.S_IMODE(os.stat(path).st_mode) == 0o640
+
+
+def test_store_roundtrip(tmpdir):
+    store = config_backup.BackupStore(str(tmpdir))
+    first = synthetic.generate_config('junos', 5000).encode('utf-8')
+    second = first.replace(b'"port 20"', b'"port 20 uplink"')
+
+    assert store.put('r1', first)['version'] == 1
+    assert store.put('r1', first) is None
+    written = store.written
+    assert store.put('r1', second)['version'] == 2
+    assert store.written - written <= 3
+
+    assert store.get('r1', 1)[1] == first
+    assert store.get('r1')[1] == second
+
+
+@pytest.mark.parametrize('edit', ['delete', 'modify'])
+def test_dest_restored(tmpdir, edit):
+    dest = tmpdir.join('dest', 'r1.cfg')
+    args = {'backup_path': str(tmpdir.join('backup')), 'name': 'r1', 'content': 'hostname r1\n', 'dest': str(dest)}
+
+    for changed in (True, False):
+        action, templar = fixtures.make_action(config_backup, dict(args))
+        assert action.run(task_vars=dict()).get('changed', False) is changed
+    assert dest.read() == 'hostname r1\n'
+
+    if edit == 'delete':
+        dest.remove()
+    else:
+        dest.write('hostname edited\n')
+
+    action, templar = fixtures.make_action(config_backup, dict(args))
+    result = action.run(task_vars=dict())
+    assert result['changed'] is True
+    assert 'version' not in result
+    assert dest.read() == 'hostname r1\n'
@@ -0,0 +1,128 @@
+# -*- coding: utf-8 -*-
+
+# (c) 2018, Ansible by Red Hat, inc
+# GNU General Public License v3.0+ (see COPYING or https://www.gnu.org/licenses/gpl-3.0.txt)
+from __future__ import (absolute_import, division, print_function)
+
+import pytest
+
+import fixtures
+
+fixtures.load_worker_modules()
+config_diff = fixtures.load_plugin('config_diff')
+
+
+ACL = """ip access-list extended test
+ permit 1.1.1.1
+ deny any
+"""
+
+INTERFACES = """interface e1
+ description x
+ mtu 1500
+interface e2
+ description y
+"""
+
+JUNOS = """system {
+    host-name r1;
+    services {
+        ssh;
+    }
+}
+interfaces {
+    ge-0/0/0 {
+        unit 0;
+    }
+}
+"""
+
+
+def run_diff(candidate, running, **args):
+    args.update({'candidate': candidate, 'running': running})
+    action, templar = fixtures.make_action(config_diff, args)
+    result = action.run(task_vars=dict())
+    assert not result.get('failed'), result.get('msg')
+    return result['updates'], result['removed'], result['changed']
+
+
+@pytest.mark.parametrize('config', [ACL, INTERFACES, JUNOS])
+def test_identical(config):
+    assert run_diff(config, config) == ([], [], False)
+    # the same tree written with other line endings
+    assert run_diff(config.replace('\n', '\r\n'), config) == ([], [], False)
+
+
+def test_added_and_removed_lines():
+    candidate = INTERFACES.replace(' mtu 1500', ' mtu 9000') + 'interface e3\n'
+    assert run_diff(candidate, INTERFACES) == (
+        ['interface e1', ' mtu 9000', 'interface e3'],
+        ['interface e1', ' mtu 1500'],
+        True,
+    )
+
+
+def test_reordered_lines():
+    candidate = """ip access-list extended test
+ deny any
+ permit 1.1.1.1
+"""
+    # removing the permit line and adding it back appends it after deny
+    updates, removed, changed = run_diff(candidate, ACL)
+    assert updates == ['ip access-list extended test', ' permit 1.1.1.1']
+    assert removed == ['ip access-list extended test', ' permit 1.1.1.1']
+
+
+def test_inserted_before_common_lines():
+    candidate = """ip access-list extended test
+ permit 1.1.1.1
+ permit 2.2.2.2
+ deny any
+"""
+    updates, removed, changed = run_diff(candidate, ACL)
+    assert updates == ['ip access-list extended test', ' permit 2.2.2.2', ' deny any']
+    assert removed == ['ip access-list extended test', ' deny any']
+
+
+def test_appended_lines():
+    candidate = ACL + ' remark end\n'
+    assert run_diff(candidate, ACL) == (['ip access-list extended test', ' remark end'], [], True)
+
+
+def test_repeated_lines():
+    running = 'route-map x\n set community 1\n set community 1\n'
+    candidate = running + ' set community 1\n'
+    assert run_diff(candidate, running) == (['route-map x', ' set community 1'], [], True)
+    assert run_diff(running, candidate) == ([], ['route-map x', ' set community 1'], True)
+
+
+def test_unordered_sections():
+    candidate = """interface e1
+ mtu 1500
+ description x
+interface e2
+ description y
+"""
+    assert run_diff(candidate, INTERFACES, unordered_sections=['^interface'])[2] is False
+    assert run_diff(candidate, INTERFACES)[2] is True
+
+    # new top level sections only leave the others alone when the top level
+    # is unordered
+    candidate = 'interface e0\n' + INTERFACES
+    assert run_diff(candidate, INTERFACES, unordered_sections=['^$'])[:2] == (['interface e0'], [])
+    assert run_diff(candidate, INTERFACES)[1] == INTERFACES.rstrip('\n').split('\n')
+
+
+def test_braced_config():
+    candidate = JUNOS.replace('        ssh;\n', '        ssh;\n        netconf;\n')
+    candidate = candidate.replace('unit 0;', 'unit 1;')
+    updates, removed, changed = run_diff(candidate, JUNOS)
+    assert updates == [
+        'system {', '    services {', '        netconf;',
+        'interfaces {', '    ge-0/0/0 {', '        unit 1;',
+    ]
+    assert removed == ['interfaces {', '    ge-0/0/0 {', '        unit 0;']
+
+    # the hierarchy follows the braces, not the indentation
+    flat = '\n'.join(line.strip() for line in candidate.split('\n'))
+    assert run_diff(flat, candidate)[2] is False
@@ -0,0 +1,33 @@
+# -*- coding: utf-8 -*-
+
+# (c) 2018, Ansible by Red Hat, inc
+# GNU General Public License v3.0+ (see COPYING or https://www.gnu.org/licenses/gpl-3.0.txt)
+from __future__ import (absolute_import, division, print_function)
+
+import pytest
+
+import fixtures
+
+fixtures.load_worker_modules()
+config_fetch = fixtures.load_plugin('config_fetch')
+
+
+@pytest.mark.skipif(not config_fetch.HAS_ASYNCSSH, reason='requires python 3 and asyncssh')
+def test_hosts_rejected_one_at_a_time(tmpdir):
+    hostvars = {
+        'missing': {},
+        'unknown': {'ansible_network_os': 'unknown'},
+        'asa': {'ansible_network_os': 'asa'},
+        # nothing listens on the port, the host is contacted and fails
+        'ios': {'ansible_network_os': 'ios', 'ansible_host': '127.0.0.1', 'ansible_port': 1},
+    }
+    action, templar = fixtures.make_action(config_fetch, {'dest': str(tmpdir), 'timeout': 5})
+    result = action.run(task_vars={'ansible_play_hosts': sorted(hostvars), 'hostvars': hostvars})
+
+    assert not result.get('failed'), result.get('msg')
+    assert result['failed_hosts'] == sorted(hostvars)
+    assert 'ansible_network_os is not set' in result['hosts']['missing']['msg']
+    assert 'network os unknown' in result['hosts']['unknown']['msg']
+    assert 'become' in result['hosts']['asa']['msg']
+    assert 'elapsed' in result['hosts']['ios']
+    assert result['hosts']['missing']['path'] == str(tmpdir.join('missing'))
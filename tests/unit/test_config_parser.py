@@ -0,0 +1,248 @@
+# -*- coding: utf-8 -*-
+
+# (c) 2018, Ansible by Red Hat, inc
+# GNU General Public License v3.0+ (see COPYING or https://www.gnu.org/licenses/gpl-3.0.txt)
+from __future__ import (absolute_import, division, print_function)
+
+import re
+
+import pytest
+
+import fixtures
+import synthetic
+
+fixtures.load_worker_modules()
+config_parser = fixtures.load_plugin('config_parser')
+
+
+@pytest.mark.parametrize('value, reference', [
+    ('{{ name }}', ('name', ())),
+    ('{{ name.0 }}', ('name', ((0, True),))),
+    ('{{ item.name }}', ('item', (('name', False),))),
+    ("{{ item['name'][1] }}", ('item', (('name', True), (1, True)))),
+    ('{{ name | upper }}', None),
+    ('{{ name }}-x', None),
+    ('{{ name[True] }}', None),
+])
+def test_compile_reference(value, reference):
+    action, templar = fixtures.make_action(config_parser, dict())
+    assert config_parser.compile_reference(value, templar.environment) == reference
+
+
+# each case is the fact value and the variables
+FILL_CASES = [
+    ('{{ v.0 }}', {'v': ['a', 'b']}),
+    ('{{ v.1 }}', {'v': ['10']}),
+    ('{{ v.k }}', {'v': {'k': 'value'}}),
+    ("{{ v['k'] }}", {'v': {'k': 'value'}}),
+    ("{{ v['items'] }}", {'v': {'items': 'value'}}),
+    ('{{ v.0.0 }}', {'v': [['a']]}),
+    ('{{ v.missing }}', {'v': {}}),
+    ('{{ v.0 }}', {'v': ['True']}),
+    ('{{ v.0 }}', {'v': ['[1, 2]']}),
+    ('{{ v.0 }}', {'v': [5]}),
+    ('{{ missing.0 }}', {}),
+]
+
+
+@pytest.mark.parametrize('value, variables', FILL_CASES)
+def test_fill_facts_matches_templar(value, variables):
+    action, templar = fixtures.make_action(config_parser, dict())
+    node = config_parser.compile_facts({'fact': value}, templar.environment, [])
+
+    # a skeleton without references is always filled in by the templar
+    slow = config_parser.DictFact(tuple((key, item._replace(reference=None)) for key, item in node.items))
+
+    assert action.fill_facts(node, dict(variables)) == action.fill_facts(slow, dict(variables))
+
+
+IOS_CONFIG = """hostname r1
+!
+interface e1
+ description x
+ ip address 10.0.0.1 255.0.0.0
+!
+interface e2
+router bgp 1
+ neighbor 1.1.1.1
+  address-family ipv4
+"""
+
+JUNOS_CONFIG = """system {
+    host-name r1;
+}
+interfaces {
+    ge-0/0/0 {
+        unit 0 {
+            family inet;
+        }
+    }
+}
+"""
+
+
+def test_iter_sections_indented():
+    assert list(config_parser.iter_sections(IOS_CONFIG.split('\n'))) == [
+        (['hostname r1'], []),
+        (['interface e1', ' description x', ' ip address 10.0.0.1 255.0.0.0'], [('interface e1', 0, 3)]),
+        (['interface e2'], []),
+        (['router bgp 1', ' neighbor 1.1.1.1', '  address-family ipv4'],
+         [('router bgp 1', 0, 3), ('neighbor 1.1.1.1', 1, 3)]),
+    ]
+
+
+def test_iter_sections_braced():
+    assert list(config_parser.iter_sections(JUNOS_CONFIG.split('\n'))) == [
+        (['system {', '    host-name r1;'], [('system {', 0, 2)]),
+        (['interfaces {', '    ge-0/0/0 {', '        unit 0 {', '            family inet;'],
+         [('interfaces {', 0, 4), ('ge-0/0/0 {', 1, 4), ('unit 0 {', 2, 4)]),
+    ]
+
+
+def test_section_index():
+    index = config_parser.SectionIndex(IOS_CONFIG)
+    assert index.find(re.compile('^interface')) == [(1, 4)]
+    assert index.find(re.compile('^neighbor')) == [(6, 8)]
+    assert index.get_block(1, 4) == 'interface e1\n description x\n ip address 10.0.0.1 255.0.0.0\nend'
+
+
+def test_literal_scanner():
+    scanner = config_parser.LiteralScanner(['inter', 'interface', 'mtu'])
+    assert scanner.scan('interface e1') == set(['inter', 'interface'])
+    assert scanner.scan(' mtu 1500\n inter') == set(['inter', 'mtu'])
+    assert scanner.scan('hostname r1') == set()
+
+
+def test_fact_builder_merge():
+    builder = config_parser.FactBuilder()
+    first = {'system': {'hostname': 'r1', 'servers': ['a']}, 'mode': 'a'}
+    builder.merge(first)
+    builder.merge({'system': {'domain': 'example.com', 'servers': ['b', 'a', {'x': 1}]}, 'mode': None})
+    builder.merge({'system': {'servers': [{'x': 1}, 'c']}, 'mode': ['list']})
+
+    assert builder.facts == {
+        'system': {'hostname': 'r1', 'domain': 'example.com', 'servers': ['a', 'b', {'x': 1}, 'c']},
+        'mode': ['list'],
+    }
+    # the merged objects are copied, never modified
+    assert first == {'system': {'hostname': 'r1', 'servers': ['a']}, 'mode': 'a'}
+
+
+ORDER_PARSER = """
+- name: global
+  matches:
+    - pattern: 'hostname (\\S+)'
+      match_var: hostname
+  facts:
+    owner: "{{ hostname.0 }}"
+    names: ["{{ hostname.0 }}"]
+
+- name: interfaces
+  section: '^interface'
+  matches:
+    - pattern: 'interface (\\S+)'
+      match_var: name
+  facts:
+    owner: "{{ name.0 }}"
+    names: ["{{ name.0 }}"]
+
+- name: last
+  matches:
+    - pattern: 'router bgp (\\S+)'
+      match_var: asn
+  facts:
+    names: ["{{ asn.0 }}"]
+"""
+
+
+def parse_both(tmpdir, parser, config):
+    """ Returns the facts of parse() and of the streaming parse_file mode
+    """
+    tmpdir.ensure('parsers', dir=True).join('test.yaml').write(parser)
+    tmpdir.join('output').write(config)
+
+    results = list()
+    for args in ({'output': config}, {'output_file': str(tmpdir.join('output'))}):
+        args['src'] = 'test.yaml'
+        action, templar = fixtures.make_action(config_parser, args, search_path=[str(tmpdir)])
+        result = action.run(task_vars=dict())
+        assert not result.get('failed'), result.get('msg')
+        results.append(result['ansible_facts'])
+    return results
+
+
+def test_stream_merges_in_entry_order(tmpdir):
+    full, stream = parse_both(tmpdir, ORDER_PARSER, IOS_CONFIG)
+    assert full == {'owner': 'e1', 'names': ['r1', 'e1', 1]}
+    assert stream == full
+
+
+@pytest.mark.parametrize('provider, parser', [('ios', 'ios.yaml'), ('junos', 'junos.yaml')])
+def test_stream_matches_parse(tmpdir, provider, parser):
+    with open(fixtures.os.path.join(fixtures.HERE, 'parsers', parser)) as f:
+        contents = f.read()
+    full, stream = parse_both(tmpdir, contents, synthetic.generate_config(provider, 500))
+    assert full
+    assert stream == full
+
+
+MULTILINE_PARSER = """
+- name: version
+  matches:
+    - pattern: 'version\\n\\s+(\\S+)'
+      match_var: version
+  facts:
+    version: "{{ version.0 }}"
+"""
+
+
+@pytest.mark.parametrize('first, second', [('output_file', 'output'), ('output', 'output_file')])
+def test_cache_per_parse_mode(tmpdir, first, second):
+    tmpdir.ensure('parsers', dir=True).join('test.yaml').write(MULTILINE_PARSER)
+    tmpdir.join('output').write('version\n  15.2\n')
+    expected = {'output': {'version': '15.2'}, 'output_file': {'version': None}}
+
+    for mode in (first, second, first):
+        args = {'src': 'test.yaml', 'cache_dir': str(tmpdir.join('cache'))}
+        args[mode] = str(tmpdir.join('output')) if mode == 'output_file' else 'version\n  15.2\n'
+        action, templar = fixtures.make_action(config_parser, args, search_path=[str(tmpdir)])
+        result = action.run(task_vars=dict())
+        assert result['ansible_facts'] == expected[mode]
+
+
+def test_output_dir_matches_outputs(tmpdir):
+    tmpdir.ensure('parsers', dir=True).join('test.yaml').write(MULTILINE_PARSER + ORDER_PARSER)
+    outputs = {'r1': 'version\n  15.2\n' + IOS_CONFIG, 'r2': synthetic.generate_config('ios', 200, 'r2')}
+    for host, output in outputs.items():
+        tmpdir.ensure('backup', dir=True).join('%s.cfg' % host).write(output)
+
+    results = list()
+    for args in ({'outputs': outputs}, {'output_dir': str(tmpdir.join('backup')), 'hosts': sorted(outputs), 'suffix': '.cfg'}):
+        args['src'] = 'test.yaml'
+        action, templar = fixtures.make_action(config_parser, args, search_path=[str(tmpdir)])
+        result = action.run(task_vars=dict())
+        assert result['failed_hosts'] == []
+        results.append(result['hosts'])
+
+    assert results[0]['r1']['ansible_facts']['version'] == '15.2'
+    assert results[1] == results[0]
+
+
+def test_workers_match_serial(tmpdir):
+    with open(fixtures.os.path.join(fixtures.HERE, 'parsers', 'ios.yaml')) as f:
+        tmpdir.ensure('parsers', dir=True).join('test.yaml').write(f.read())
+    config = synthetic.generate_config('ios', 500)
+    outputs = dict(('r%d' % i, synthetic.generate_config('ios', 100, 'r%d' % i)) for i in range(4))
+
+    results = list()
+    for workers in (1, 3):
+        action, templar = fixtures.make_action(config_parser, {'src': 'test.yaml', 'output': config, 'workers': workers},
+                                               search_path=[str(tmpdir)])
+        facts = action.run(task_vars=dict())['ansible_facts']
+        action, templar = fixtures.make_action(config_parser, {'src': 'test.yaml', 'outputs': outputs, 'workers': workers},
+                                               search_path=[str(tmpdir)])
+        results.append((facts, action.run(task_vars=dict())['hosts']))
+
+    assert results[0][0]
+    assert sorted(results[0][1]) == sorted(outputs)
+    assert results[1] == results[0]
@@ -0,0 +1,356 @@
+# -*- coding: utf-8 -*-
+
+# (c) 2018, Ansible by Red Hat, inc
+# GNU General Public License v3.0+ (see COPYING or https://www.gnu.org/licenses/gpl-3.0.txt)
+from __future__ import (absolute_import, division, print_function)
+
+import os
+import json
+import stat
+import pickle
+
+import pytest
+
+from ansible.utils.unsafe_proxy import wrap_var
+
+import fixtures
+
+fixtures.load_worker_modules()
+config_template = fixtures.load_plugin('config_template')
+
+
+def render(tmpdir, source, templates=None, task_vars=None, **args):
+    """ Renders the source template with the given included templates
+    """
+    tmpdir.ensure('source', dir=True).join('source.yaml').write(source)
+    tmpdir.ensure('templates', dir=True)
+    for name, data in (templates or dict()).items():
+        tmpdir.join('templates', name).write(data)
+
+    args['source_dir'] = str(tmpdir.join('source'))
+    action, templar = fixtures.make_action(config_template, args, search_path=[str(tmpdir)])
+    return action.run(task_vars=task_vars or dict())
+
+
+MISSING_INCLUDE = """
+- name: system
+  lines: hostname r1
+
+- name: optional
+  include: doesnotexist.yaml
+  when: optional | default(false)
+"""
+
+
+def test_skipped_include_not_resolved(tmpdir):
+    result = render(tmpdir, MISSING_INCLUDE)
+    assert not result.get('failed'), result.get('msg')
+    assert result['lines'] == ['hostname r1']
+
+
+def test_rendered_missing_include_fails(tmpdir):
+    result = render(tmpdir, MISSING_INCLUDE, task_vars={'optional': True})
+    assert result['failed']
+    assert 'doesnotexist.yaml' in result['msg']
+
+
+def test_unconditional_include_cycle(tmpdir):
+    result = render(tmpdir, '- name: start\n  include: loop.yaml\n',
+                    templates={'loop.yaml': '- name: again\n  include: loop.yaml\n'})
+    assert result['failed']
+    assert 'include cycle detected' in result['msg']
+
+
+def test_conditional_include_cycle(tmpdir):
+    loop = """
+- name: line
+  lines: interface e1
+
+- name: again
+  include: loop.yaml
+  when: recurse | default(false)
+"""
+    result = render(tmpdir, '- name: start\n  include: loop.yaml\n', templates={'loop.yaml': loop})
+    assert not result.get('failed'), result.get('msg')
+    assert result['lines'] == ['interface e1']
+
+
+def test_dest_mode(tmpdir):
+    source = tmpdir.ensure('source', dir=True).join('source.yaml')
+    source.write('- name: system\n  lines: hostname r1\n')
+    dest = tmpdir.join('config')
+    action, templar = fixtures.make_action(config_template, {'source_dir': source.dirname, 'dest': str(dest)})
+
+    umask = os.umask(0o022)
+    try:
+        result = action.run(task_vars=dict())
+    finally:
+        os.umask(umask)
+    assert result['changed']
+    assert stat.S_IMODE(os.stat(str(dest)).st_mode) == 0o644
+
+    dest.chmod(0o640)
+    source.write('- name: system\n  lines: hostname r2\n')
+    result = action.run(task_vars=dict())
+    assert result['changed']
+    assert dest.read() == 'hostname r2'
+    assert stat.S_IMODE(os.stat(str(dest)).st_mode) == 0o640
+
+
+CACHED_SOURCE = """
+- name: system
+  lines: "hostname {{ hostname }}"
+
+- name: interfaces
+  block:
+    - lines:
+        - "interface {{ item }}"
+        - " mtu {{ mtu }}"
+      loop: "{{ interfaces }}"
+"""
+
+
+def test_render_cache(tmpdir):
+    cache_dir = tmpdir.join('cache')
+    task_vars = {'inventory_hostname': 'r1', 'hostname': 'r1', 'interfaces': ['e1', 'e2'], 'mtu': 1500}
+    expected = ['hostname r1', 'interface e1', ' mtu 1500', 'interface e2', ' mtu 1500']
+
+    # miss, then hit
+    for reused in ([], ['source.yaml:system', 'source.yaml:interfaces']):
+        result = render(tmpdir, CACHED_SOURCE, task_vars=task_vars, cache_dir=str(cache_dir))
+        assert result['lines'] == expected
+        assert result['reused_blocks'] == reused
+
+    # the entries depending on a changed variable are rendered again
+    task_vars['mtu'] = 9000
+    result = render(tmpdir, CACHED_SOURCE, task_vars=task_vars, cache_dir=str(cache_dir))
+    assert result['lines'] == [line.replace('1500', '9000') for line in expected]
+    assert result['reused_blocks'] == ['source.yaml:system']
+
+    # an index and one file per entry, the replaced entry file is removed
+    assert len(cache_dir.join('r1').listdir()) == 3
+
+    # an unreadable entry file is rendered again
+    for path in cache_dir.join('r1').listdir():
+        if '.' in path.basename:
+            path.write('x')
+    result = render(tmpdir, CACHED_SOURCE, task_vars=task_vars, cache_dir=str(cache_dir))
+    assert result['lines'] == [line.replace('1500', '9000') for line in expected]
+    result = render(tmpdir, CACHED_SOURCE, task_vars=task_vars, cache_dir=str(cache_dir))
+    assert result['lines'] == [line.replace('1500', '9000') for line in expected]
+    assert len(result['reused_blocks']) == 2
+
+
+def test_render_cache_streams_entries(tmpdir):
+    cache_dir = tmpdir.join('cache')
+    task_vars = {'inventory_hostname': 'r1', 'hostname': 'r1', 'interfaces': ['e1'], 'mtu': 1500}
+    render(tmpdir, CACHED_SOURCE, task_vars=task_vars, cache_dir=str(cache_dir))
+
+    action, templar = fixtures.make_action(config_template, {'source_dir': str(tmpdir.join('source')),
+                                                             'cache_dir': str(cache_dir)})
+    action.set_args()
+    action._render_cache = config_template.RenderCache(str(cache_dir.join('r1')))
+    variables = config_template.VariableScope({}, task_vars)
+    lines = action.render(action.included_files(), variables)
+
+    # the entries are read from disk as the lines are consumed
+    assert next(lines) == 'hostname r1'
+    assert action._render_cache.reused == ['source.yaml:system', 'source.yaml:interfaces']
+    for path in cache_dir.join('r1').listdir():
+        if '.' in path.basename:
+            with open(str(path), 'wb') as f:
+                pickle.dump(['interface e9'], f, 2)
+    assert list(lines) == ['interface e9']
+
+
+def test_profile_dest(tmpdir, monkeypatch):
+    source = '- name: a\n  include: a/base.yaml\n\n- name: b\n  include: b/base.yaml\n'
+    tmpdir.ensure('source', dir=True).join('source.yaml').write(source)
+    tmpdir.ensure('templates', 'a', dir=True).join('base.yaml').write('- name: a\n  lines: hostname a\n')
+    tmpdir.ensure('templates', 'b', dir=True).join('base.yaml').write('- name: b\n  lines: hostname b\n')
+    report = tmpdir.join('profile.json')
+    args = {'source_dir': str(tmpdir.join('source')), 'profile': True, 'profile_dest': str(report)}
+
+    def run(run_id, hosts):
+        monkeypatch.setattr(config_template.C, 'DEFAULT_LOCAL_TMP', run_id)
+        for host in hosts:
+            action, templar = fixtures.make_action(config_template, dict(args), search_path=[str(tmpdir)])
+            result = action.run(task_vars={'inventory_hostname': host})
+            assert not result.get('failed'), result.get('msg')
+        return json.loads(report.read())
+
+    # the included files are keyed by their path relative to source_dir
+    profile = run('run1', ['r1', 'r2'])
+    assert sorted(profile['blocks']) == ['../templates/a/base.yaml:1', '../templates/b/base.yaml:1',
+                                         'source.yaml:1', 'source.yaml:4']
+    assert profile['blocks']['../templates/a/base.yaml:1']['count'] == 2
+    assert profile['hosts'] == {'r1': 1, 'r2': 1}
+
+    # the next run replaces the report
+    profile = run('run2', ['r1'])
+    assert profile['blocks']['../templates/a/base.yaml:1']['count'] == 1
+    assert profile['hosts'] == {'r1': 1}
+
+
+def test_workers_match_serial(tmpdir):
+    source = CACHED_SOURCE + '\n'.join('- name: vlan%d\n  lines: "vlan %d"\n' % (i, i) for i in range(20))
+    task_vars = {'hostname': 'r1', 'interfaces': ['e%d' % i for i in range(10)], 'mtu': 1500}
+
+    results = [render(tmpdir, source, task_vars=task_vars, workers=workers, profile=True) for workers in (1, 3)]
+    assert results[1]['lines'] == results[0]['lines']
+    assert len(results[0]['lines']) == 41
+
+    # the profiles of the workers are merged into the task profile
+    for key, stats in results[0]['profile']['blocks'].items():
+        assert results[1]['profile']['blocks'][key]['lines'] == stats['lines']
+        assert results[1]['profile']['blocks'][key]['count'] == stats['count']
+
+
+UNSAFE = wrap_var(u'{{ secret }}')
+
+# each case is the line, the variables and whether the line is expected to
+# be formatted without the templar
+FORMAT_CASES = [
+    ('hostname {{ hostname }}', {'hostname': 'r1'}, True),
+    (u'description {{ text }}', {'text': u'caf\xe9 ☃'}, True),
+    ('mtu {{ mtu }}', {'mtu': 9000}, True),
+    ('shutdown {{ flag }}', {'flag': True}, True),
+    ('shutdown {{ flag }}', {'flag': False}, True),
+    ('bandwidth {{ value }}', {'value': 1.5}, True),
+    ('bandwidth {{ value }}', {'value': 1e20}, True),
+    ('bandwidth {{ value }}', {'value': 0.1 + 0.2}, True),
+    ('description {{ value }}', {'value': None}, False),
+    ('secret {{ value }}', {'value': UNSAFE}, True),
+    ('{{ value }}', {'value': UNSAFE}, False),
+    ('{{ value }}', {'value': wrap_var(u'secret {{ value }}')}, True),
+    ('{{ a }} {{ b }}', {'a': 'plain', 'b': wrap_var(u'{{ secret }}')}, True),
+    ('{{ value }}', {'value': '{"a": 1}'}, False),
+    ('{{ value }}', {'value': '[1, 2]'}, False),
+    ('{{ value }} and more', {'value': '[1, 2]'}, False),
+    ('{{ value }}', {'value': 'True'}, False),
+    ('{{ value }}', {'value': 'False'}, False),
+    ('{{ value }}', {'value': 'text'}, True),
+    ('{{ value }}', {'value': 5}, False),
+    ('{{ value }}', {'value': True}, False),
+    ('{{ value }}', {'value': None}, False),
+    ('ip address {{ intf.address }}', {'intf': {'address': '10.0.0.1'}}, True),
+    ('ip address {{ intf.missing }}', {'intf': {'address': '10.0.0.1'}}, False),
+    ('ip address {{ intf["address"] }}', {'intf': {'address': '10.0.0.1'}}, True),
+    ('ip address {{ intf.addresses[1] }}', {'intf': {'addresses': ['10.0.0.1', '10.0.0.2']}}, True),
+    ('ip address {{ intf.addresses[5] }}', {'intf': {'addresses': ['10.0.0.1']}}, False),
+    ('items {{ data.items }}', {'data': {'items': 'x'}}, False),
+    ('name {{ missing }}', {}, False),
+    ('name {{ value }}', {'value': '{{ other }}', 'other': 'r1'}, False),
+    ('name {{ value.name }}', {'value': {'name': 'r1', 'other': '{{ x }}'}, 'x': 1}, False),
+    ('{{ a }}{{ b }}', {'a': '{', 'b': '}'}, False),
+    ('{{ a }} {{ b }}', {'a': 1, 'b': 2}, True),
+]
+
+
+@pytest.mark.parametrize('line, variables, fast', FORMAT_CASES)
+def test_format_line_matches_templar(line, variables, fast):
+    action, templar = fixtures.make_action(config_template, dict())
+
+    parts = config_template.compile_line(line, templar.environment)
+    assert parts is not None
+
+    formatted = action._format_line(parts, variables, dict())
+    assert (formatted is not None) == fast
+
+    templar.set_available_variables(variables)
+    expected = templar.template(line, fail_on_undefined=False)
+    if formatted is not None:
+        assert formatted == expected
+        assert type(formatted) is type(expected)
+
+
+@pytest.mark.parametrize('matches, filename, matched', [
+    (['(?i)^leaf', 'spine$'], 'LEAF1.yaml', True),
+    (['(?i)^leaf', 'spine$'], 'r1-SPINE', False),
+    (['^leaf', 'spine$'], 'LEAF1.yaml', False),
+    (['(a)\\1', 'glob:*.yaml'], 'aa.txt', True),
+    (['(a)\\1', 'glob:*.yaml'], 'ab.yaml', True),
+    (['(a)\\1', 'glob:*.yaml'], 'ab.yml', False),
+])
+def test_compile_matcher(matches, filename, matched):
+    assert config_template.compile_matcher(matches)(filename) == matched
+
+
+# each case is the loop, the variables and whether the loop value is
+# expected to be taken without the templar
+LOOP_CASES = [
+    ('interfaces', {'interfaces': ['e1', 'e2']}, True),
+    ('{{ interfaces }}', {'interfaces': ['e1', 'e2']}, True),
+    ('device.interfaces', {'device': {'interfaces': [{'name': 'e1', 'mtu': 1500}]}}, True),
+    ('device["vlans"]', {'device': {'vlans': {'10': 'users', '20': None}}}, True),
+    ('interfaces', {'interfaces': []}, True),
+    ('interfaces', {'interfaces': [1.5, True, None, -3]}, True),
+    ('missing', {}, False),
+    ('{{ missing }}', {}, False),
+    (' interfaces', {'interfaces': ['e1']}, False),
+    ('interfaces', {'interfaces': 'e1'}, False),
+    ('interfaces', {'interfaces': ['{{ name }}'], 'name': 'e1'}, False),
+    ('interfaces', {'interfaces': [wrap_var(u'e1')]}, False),
+    ('interfaces', {'interfaces': [float('inf')]}, False),
+    ('interfaces | list', {'interfaces': ['e1']}, False),
+    ('device.missing', {'device': {}}, False),
+]
+
+
+def count_templar_calls(action):
+    """ Counts the values the action passes to the templar
+    """
+    calls = list()
+    template = action._template
+
+    def wrapper(value, *args, **kwargs):
+        calls.append(value)
+        return template(value, *args, **kwargs)
+
+    action._template = wrapper
+    return calls
+
+
+@pytest.mark.parametrize('loop, variables, fast', LOOP_CASES)
+def test_template_loop_matches_templar(loop, variables, fast):
+    action, templar = fixtures.make_action(config_template, dict())
+    node = config_template.BlockNode('loop', (), None, loop, 'item', None, None)
+
+    calls = count_templar_calls(action)
+    value = action._template_loop(node, variables)
+    assert (not calls) == fast
+    assert value == action.template(loop, variables, convert_bare=True)
+
+
+CONDITIONAL_CASES = [
+    ('enabled', {'enabled': True}, True),
+    ('enabled', {'enabled': False}, True),
+    ('enabled', {}, False),
+    ('enabled is defined', {}, True),
+    ('mtu | int > 1500', {'mtu': '9000'}, True),
+    ('name in names', {'name': 'e1', 'names': ['e1', 'e2']}, True),
+    ('name == value', {'name': '{{ value }}', 'value': 'e1'}, True),
+    ('lookup("env", "HOME")', {}, False),
+    ('hostvars is defined', {}, False),
+    ('enabled ==', {'enabled': True}, False),
+]
+
+
+@pytest.mark.parametrize('when, variables, fast', CONDITIONAL_CASES)
+def test_check_conditional_matches_templar(when, variables, fast):
+    action, templar = fixtures.make_action(config_template, dict())
+    conditional = config_template.CONDITIONAL % when
+    node = config_template.BlockNode('when', (), conditional, None, 'item', None, None)
+
+    try:
+        expected = action.template(conditional, variables)
+    except Exception as exc:
+        expected = type(exc)
+
+    calls = count_templar_calls(action)
+    try:
+        value = action._check_conditional(node, variables)
+    except Exception as exc:
+        value = type(exc)
+    assert (not calls) == fast
+    assert value == expected